@@ -0,0 +1,58 @@
+'''
+Import time benchmark. Every statement is run in a fresh interpreter and the median time is compared with its budget
+in seconds. Exits with status 1 when a budget is exceeded or when a statement loads a module it should not load.
+
+>> python benchmarks/import_time.py
+'''
+import statistics
+import subprocess
+import sys
+
+RUNS = 5
+BUDGETS = [
+    # (statement, budget in seconds, modules that must not be loaded)
+    ('import ezgoogleapi', 0.05, ['pandas', 'googleapiclient', 'google.cloud.bigquery']),
+    ('from ezgoogleapi import analytics', 0.05, ['pandas', 'googleapiclient']),
+    ('from ezgoogleapi.analytics import Body', 1.0, ['google.cloud.bigquery', 'googleapiclient.discovery']),
+    ('from ezgoogleapi.analytics import Query', 1.5, ['google.cloud.bigquery']),
+    ('from ezgoogleapi.sheets import SpreadSheet', 1.5, ['google.cloud.bigquery']),
+    ('from ezgoogleapi.bigquery import BigQuery', 2.5, [])
+]
+
+SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(','.join(name for name in {forbidden!r} if name in sys.modules))
+'''
+
+
+def measure(statement: str, forbidden: list):
+    times = []
+    loaded = ''
+    for _ in range(RUNS):
+        output = subprocess.run([sys.executable, '-c', SCRIPT.format(statement=statement, forbidden=forbidden)],
+                                capture_output=True, text=True, check=True).stdout.splitlines()
+        times.append(float(output[0]))
+        loaded = output[1] if len(output) > 1 else ''
+    return statistics.median(times), loaded
+
+
+def main() -> int:
+    failed = False
+    for statement, budget, forbidden in BUDGETS:
+        elapsed, loaded = measure(statement, forbidden)
+        status = 'ok'
+        if elapsed > budget:
+            status = 'OVER BUDGET'
+        if loaded:
+            status = f'loads {loaded}'
+        failed = failed or status != 'ok'
+        print(f'{elapsed:7.3f}s  budget {budget:5.2f}s  {status:12}  {statement}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,56 @@
-from ezgoogleapi.analytics.body import Body
-from ezgoogleapi.analytics.daterange import (TODAY,
-                                             YESTERDAY,
-                                             LAST_WEEK,
-                                             LAST_7_DAYS,
-                                             THIS_MONTH,
-                                             LAST_MONTH,
-                                             LAST_90_DAYS,
-                                             LAST_YEAR,
-                                             CURRENT_QUARTER,
-                                             LAST_QUARTER,
-                                             quarter,
-                                             weeks,
-                                             last_weeks,
-                                             last_days)
-from ezgoogleapi.analytics.query import Query
-from ezgoogleapi.analytics.variable_names import VariableName, NameDatabase
-from ezgoogleapi.bigquery.base import BigQuery
-from ezgoogleapi.bigquery.schema import schema, SchemaTypes
-from ezgoogleapi.sheets import SpreadSheet, Permission
+import importlib
+
+# Names are imported from their submodule on first access, so importing one part of the package does not load the
+# dependencies of the others.
+_exports = {
+    'Body': 'ezgoogleapi.analytics.body',
+    'TODAY': 'ezgoogleapi.analytics.daterange',
+    'YESTERDAY': 'ezgoogleapi.analytics.daterange',
+    'LAST_WEEK': 'ezgoogleapi.analytics.daterange',
+    'LAST_7_DAYS': 'ezgoogleapi.analytics.daterange',
+    'THIS_MONTH': 'ezgoogleapi.analytics.daterange',
+    'LAST_MONTH': 'ezgoogleapi.analytics.daterange',
+    'LAST_90_DAYS': 'ezgoogleapi.analytics.daterange',
+    'LAST_YEAR': 'ezgoogleapi.analytics.daterange',
+    'CURRENT_QUARTER': 'ezgoogleapi.analytics.daterange',
+    'LAST_QUARTER': 'ezgoogleapi.analytics.daterange',
+    'quarter': 'ezgoogleapi.analytics.daterange',
+    'weeks': 'ezgoogleapi.analytics.daterange',
+    'last_weeks': 'ezgoogleapi.analytics.daterange',
+    'last_days': 'ezgoogleapi.analytics.daterange',
+    'DateRange': 'ezgoogleapi.analytics.daterange',
+    'Query': 'ezgoogleapi.analytics.query',
+    'AsyncQuery': 'ezgoogleapi.analytics.async_query',
+    'QueryScheduler': 'ezgoogleapi.analytics.scheduler',
+    'ReportCache': 'ezgoogleapi.analytics.cache',
+    'CsvSink': 'ezgoogleapi.analytics.sinks',
+    'SqliteSink': 'ezgoogleapi.analytics.sinks',
+    'VariableName': 'ezgoogleapi.analytics.variable_names',
+    'NameDatabase': 'ezgoogleapi.analytics.variable_names',
+    'BigQuery': 'ezgoogleapi.bigquery.base',
+    'schema': 'ezgoogleapi.bigquery.schema',
+    'SchemaTypes': 'ezgoogleapi.bigquery.schema',
+    'SpreadSheet': 'ezgoogleapi.sheets.base',
+    'Permission': 'ezgoogleapi.sheets.base',
+    'configure_transport': 'ezgoogleapi.common.connections'
+}
+_submodules = ['analytics', 'bigquery', 'sheets', 'common']
+
+__all__ = list(_exports) + _submodules
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module(_exports[name]), name)
+    elif name in _submodules:
+        value = importlib.import_module(f'{__name__}.{name}')
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    if name != 'TODAY':
+        # TODAY is looked up again on every access, so it does not keep the time of the first access.
+        globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
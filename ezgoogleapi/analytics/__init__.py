@@ -1,17 +1,44 @@
-from ezgoogleapi.analytics.body import Body
-from ezgoogleapi.analytics.daterange import (TODAY,
-                                             YESTERDAY,
-                                             LAST_WEEK,
-                                             LAST_7_DAYS,
-                                             THIS_MONTH,
-                                             LAST_MONTH,
-                                             LAST_90_DAYS,
-                                             LAST_YEAR,
-                                             CURRENT_QUARTER,
-                                             THIS_YEAR,
-                                             LAST_QUARTER,
-                                             quarter,
-                                             weeks)
-from ezgoogleapi.analytics.query import Query
-from ezgoogleapi.analytics.variable_names import VariableName, NameDatabase
+import importlib
 
+# Names are imported from their submodule on first access, see ezgoogleapi/__init__.py.
+_exports = {
+    'Body': 'ezgoogleapi.analytics.body',
+    'TODAY': 'ezgoogleapi.analytics.daterange',
+    'YESTERDAY': 'ezgoogleapi.analytics.daterange',
+    'LAST_WEEK': 'ezgoogleapi.analytics.daterange',
+    'LAST_7_DAYS': 'ezgoogleapi.analytics.daterange',
+    'THIS_MONTH': 'ezgoogleapi.analytics.daterange',
+    'LAST_MONTH': 'ezgoogleapi.analytics.daterange',
+    'LAST_90_DAYS': 'ezgoogleapi.analytics.daterange',
+    'LAST_YEAR': 'ezgoogleapi.analytics.daterange',
+    'CURRENT_QUARTER': 'ezgoogleapi.analytics.daterange',
+    'THIS_YEAR': 'ezgoogleapi.analytics.daterange',
+    'LAST_QUARTER': 'ezgoogleapi.analytics.daterange',
+    'quarter': 'ezgoogleapi.analytics.daterange',
+    'weeks': 'ezgoogleapi.analytics.daterange',
+    'DateRange': 'ezgoogleapi.analytics.daterange',
+    'Query': 'ezgoogleapi.analytics.query',
+    'AsyncQuery': 'ezgoogleapi.analytics.async_query',
+    'QueryScheduler': 'ezgoogleapi.analytics.scheduler',
+    'ReportCache': 'ezgoogleapi.analytics.cache',
+    'CsvSink': 'ezgoogleapi.analytics.sinks',
+    'SqliteSink': 'ezgoogleapi.analytics.sinks',
+    'VariableName': 'ezgoogleapi.analytics.variable_names',
+    'NameDatabase': 'ezgoogleapi.analytics.variable_names'
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(_exports[name]), name)
+    if name != 'TODAY':
+        # TODAY is looked up again on every access, so it does not keep the time of the first access.
+        globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
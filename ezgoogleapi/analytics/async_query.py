@@ -0,0 +1,232 @@
+import asyncio
+import inspect
+import random
+from collections import deque
+from typing import Any, AsyncIterator, Callable, List
+
+import pandas as pd
+
+from ezgoogleapi.analytics.cache import ReportCache, SETTLE_DAYS
+from ezgoogleapi.analytics.daterange import DateRange, chunk_days
+from ezgoogleapi.analytics.parser import ReportReader, ResourceQuotaRetry, concat_results, join_results, split_body
+from ezgoogleapi.common.connections import get_credentials, refresh
+from ezgoogleapi.analytics.query import Query, SCOPES, MAX_WORKERS, MAX_PAGE_SIZE, RETRIES, _cached_ranges, \
+    _cache_ranges, _check_chunking, _check_workers, _describe, page_body
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+ENDPOINT = 'https://analyticsreporting.googleapis.com/v4/reports:batchGet'
+# Responses which are retried with exponential backoff, like googleapiclient does for Query.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF = 1
+
+
+class AsyncQuery(Query):
+    def __init__(self, body, keyfile: str = None, clean_up: Callable = None, cache: ReportCache = None,
+                 credentials: Any = None, session: Any = None, concurrency: int = MAX_WORKERS,
+                 endpoint: str = ENDPOINT):
+        '''
+        Asyncio counterpart of Query. Requests are sent over a pooled aiohttp session, so many queries can run in a
+        single event loop. Results are parsed and exported in the same way as for Query.
+
+        :param body: ezgoogleapi.analytics.Body object
+        :param keyfile: JSON keyfile name in the form "file_name.json". Not needed when credentials are supplied.
+        :param cache: [optional] ReportCache object to reuse results from earlier runs.
+        :param credentials: [optional] google.auth credentials to use instead of the keyfile.
+        :param session: [optional] aiohttp.ClientSession to share between queries. If not specified, the query
+            creates its own session, which is closed by AsyncQuery.close().
+        :param concurrency: [optional] Maximum amount of requests in flight for this query. Default: 10, the amount
+            of concurrent requests Google Analytics allows per view.
+        :param endpoint: [optional] URL of the reports:batchGet method, e.g. of a local stub server for testing.
+        '''
+        if aiohttp is None:
+            raise ImportError('AsyncQuery requires aiohttp. Install it with "pip install aiohttp".')
+        self.credentials = credentials
+        self.session = session
+        self._own_session = session is None
+        self.concurrency = _check_workers(concurrency)
+        self.endpoint = endpoint
+        self._semaphore = None
+        self._token_lock = None
+        super().__init__(body, keyfile, clean_up, cache)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def run(self, per_day=True, sampling='fail', clean_headers=False, logging=True, pack_days: bool = False,
+                  chunking: str = None):
+        '''
+        Execute API requests for given body and given date range. Saves result to AsyncQuery.results,
+        which can be exported to csv, dataframe and sqlite. Takes the same parameters as Query.run(), the chunks are
+        fetched with the concurrency given to AsyncQuery. The 'adaptive' chunking is not supported.
+
+        >> await query.run()
+        '''
+        async for result in self.iter_results(per_day, sampling, clean_headers, logging, pack_days, chunking):
+            self.results.append(result)
+
+    async def iter_results(self, per_day=True, sampling='fail', clean_headers=False, logging=True,
+                           pack_days: bool = False, chunking: str = None) -> AsyncIterator[pd.DataFrame]:
+        '''
+        Yield the result of every chunk in date order as soon as it arrives, instead of saving it to
+        AsyncQuery.results.
+
+        >> async for df in query.iter_results():
+        >>     print(len(df))
+        '''
+        chunking = _check_chunking(chunking, per_day)
+        if chunking == 'adaptive':
+            raise ValueError('AsyncQuery does not support the \'adaptive\' chunking. Use \'day\', \'week\' or '
+                             '\'month\'.')
+        self._open()
+        dates = self.date_range
+        if not chunking:
+            body = self.body.request([{'startDate': dates[0], 'endDate': dates[-1]}])
+            result = concat_results(await self._get_report_ranges(body, sampling))
+            yield self._clean_result(result, clean_headers)
+            return
+
+        tasks = deque()
+
+        async def results():
+            packed, task = tasks.popleft()
+            for chunk, result in zip(packed, await task):
+                if logging:
+                    print(f'Result for {_describe(chunk)} contains {len(result)} rows')
+                yield self._clean_result(result, clean_headers)
+
+        try:
+            for packed, body in self._chunks(chunk_days(dates, chunking), pack_days):
+                tasks.append((packed, asyncio.ensure_future(self._get_report_ranges(body, sampling))))
+                if len(tasks) >= self.concurrency * 2:
+                    async for result in results():
+                        yield result
+            while tasks:
+                async for result in results():
+                    yield result
+        finally:
+            for _, task in tasks:
+                task.cancel()
+
+    async def stream(self, sink: Callable[[pd.DataFrame], Any], **run_options):
+        '''
+        Execute the queries and pass the result of every day to a sink as soon as it arrives. The sink may be a
+        regular function, a coroutine function or one of the sinks from ezgoogleapi.analytics.sinks.
+        '''
+        try:
+            async for result in self.iter_results(**run_options):
+                written = sink(result)
+                if inspect.isawaitable(written):
+                    await written
+        finally:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+    async def refresh(self, target, unsettled_days: int = SETTLE_DAYS, date_column: str = None, **run_options):
+        '''
+        Bring a table filled by an earlier run up to date, like Query.refresh(). Takes the same parameters. Reading
+        the latest date from the table and writing the results happen in a thread, so the event loop is not blocked.
+
+        >> await query.refresh(SqliteSink('example.db'))
+        '''
+        loop = asyncio.get_running_loop()
+        plan = await loop.run_in_executor(None, self._refresh_plan, target, unsettled_days, date_column,
+                                          run_options.get('logging', True))
+        if plan is None:
+            return
+        run_options['clean_headers'] = False
+        date_range, self.date_range = self._date_range, DateRange(plan[1], self.date_range[-1])
+        try:
+            results = [result async for result in self.iter_results(**run_options)]
+        finally:
+            self.date_range = date_range
+        await loop.run_in_executor(None, self._replace, target, plan, results)
+
+    async def close(self):
+        if self._own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _connect(self, keyfile):
+        if self.credentials is None:
+            self.credentials = get_credentials(keyfile, SCOPES)
+        return None
+
+    def _open(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency))
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._token_lock = asyncio.Lock()
+
+    async def _get_report_ranges(self, body: dict, sampling: str) -> List[pd.DataFrame]:
+        keys = self._keys(body, sampling)
+        cached = _cached_ranges(keys, body['reportRequests'][0]['dateRanges'], self.cache)
+        if cached is not None:
+            return cached
+        results = await self._fetch_report_ranges(body, sampling)
+        _cache_ranges(keys, results, self.cache)
+        return results
+
+    async def _fetch_report_ranges(self, body: dict, sampling: str) -> List[pd.DataFrame]:
+        if len(body['reportRequests']) > 1:
+            results = await asyncio.gather(*[self._fetch_report_ranges(sub_body, sampling)
+                                             for sub_body in split_body(body)])
+            return join_results(body['reportRequests'], results)
+        request = body['reportRequests'][0]
+        if 'pageSize' not in request:
+            request['pageSize'] = MAX_PAGE_SIZE
+        reader = ReportReader(body, self.resource_quota, sampling)
+        try:
+            report = await self._batch_get(body)
+            if not reader.add(report):
+                return reader.results()
+            token = report.get('nextPageToken')
+            row_count = report['data'].get('rowCount')
+
+            # Page tokens of the Reporting API are row offsets, so the remaining pages are known after the first one.
+            if token and token.isdigit() and row_count:
+                reports = await asyncio.gather(*[self._batch_get(page_body(body, offset)) for offset in
+                                                 range(int(token), row_count, request['pageSize'])])
+                for report in reports:
+                    if not reader.add(report):
+                        break
+            else:
+                while token:
+                    report = await self._batch_get(page_body(body, token))
+                    if not reader.add(report):
+                        break
+                    token = report.get('nextPageToken')
+        except ResourceQuotaRetry:
+            body['useResourceQuotas'] = True
+            return await self._fetch_report_ranges(body, sampling)
+        return reader.results()
+
+    async def _batch_get(self, body: dict) -> dict:
+        for attempt in range(RETRIES + 1):
+            # The slot is released while waiting, so other requests can use it.
+            async with self._semaphore:
+                try:
+                    async with self.session.post(self.endpoint, json=body, headers=await self._headers()) as response:
+                        if response.status not in RETRY_STATUSES or attempt == RETRIES:
+                            response.raise_for_status()
+                            return (await response.json())['reports'][0]
+                except aiohttp.ClientConnectionError:
+                    if attempt == RETRIES:
+                        raise
+            await asyncio.sleep(BACKOFF * 2 ** attempt + random.uniform(0, BACKOFF))
+
+    async def _headers(self) -> dict:
+        if not self.credentials.valid:
+            async with self._token_lock:
+                if not self.credentials.valid:
+                    await asyncio.get_running_loop().run_in_executor(None, refresh, self.credentials)
+        headers = {}
+        self.credentials.apply(headers)
+        return headers
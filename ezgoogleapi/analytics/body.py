@@ -1,13 +1,19 @@
 import json
+import re
 from datetime import datetime
 import warnings
 from typing import Union
 
+from ezgoogleapi.analytics.cache import ReportCache
 from ezgoogleapi.analytics.variable_names import VariableName
 from ezgoogleapi.common.validation import validate_json_file
 from itertools import count
 
 mandatory = ['view_id', 'dimensions', 'metrics', 'start', 'end', 'date_range']
+MAX_METRICS = 10
+MAX_DIMENSIONS = 7
+MAX_SEGMENTS = 4
+DATE_RANGES_SLOT = '__DATE_RANGES__'
 
 expressions = {
     'Dimension': {
@@ -25,6 +31,9 @@ expressions = {
         '>': 'GREATER_THAN'
     }
 }
+# Splits a filter at its first operator into name, operator and expression.
+FILTER_PATTERN = re.compile('^(.*?)(' + '|'.join(re.escape(op) for op in sorted(
+    set(expressions['Dimension']) | set(expressions['Metric']), key=len, reverse=True)) + ')(.*)$', re.DOTALL)
 
 
 class Body:
@@ -54,11 +63,20 @@ class Body:
         self.resource_quota = False
         self.name = None
         self.body = None
+        self.template = None
+        self.request_hash = None
         _construct_body(self)
 
     def __repr__(self):
         return f'{self.name}'
 
+    def request(self, date_ranges: list) -> dict:
+        '''
+        Return the request body for the given date ranges, e.g. [{'startDate': date, 'endDate': date}]. Every call
+        returns a new dictionary, which may be changed while the request is sent.
+        '''
+        return json.loads(json.dumps(date_ranges).join(self.template))
+
 
 def _get_date_range(body_obj: Body):
     if 'start' in body_obj.report.keys():
@@ -107,6 +125,62 @@ def _construct_body(body_obj):
     if not body_obj.name:
         body_obj.name = 'Query ' + str(body_obj.id)
 
+    _split_request(body_obj)
+    compile_template(body_obj)
+
+
+def compile_template(body_obj):
+    '''
+    Serialize the request once, with a slot for the date ranges. Bodies for a date range are then created by
+    filling in the slot, instead of changing and serializing the whole request again. The request is hashed once as
+    well, and the cache keys of every date range are derived from that hash. Call again after changing Body.body.
+    '''
+    body = json.loads(json.dumps(body_obj.body))
+    set_date_ranges(body, DATE_RANGES_SLOT)
+    body_obj.template = json.dumps(body).split(json.dumps(DATE_RANGES_SLOT))
+    body_obj.request_hash = ReportCache.request_hash(body_obj.body)
+
+
+def _split_request(body_obj):
+    '''
+    Split a request with more metrics or segments than the Reporting API allows into several requests with the same
+    dimensions. Every combination of a group of metrics and a group of segments becomes a separate request.
+    '''
+    request = body_obj.body['reportRequests'][0]
+    dimensions = [dim['name'] for dim in request['dimensions']]
+    if len(dimensions) > MAX_DIMENSIONS:
+        raise ValueError(f'{len(dimensions)} dimensions were given, including ga:segment when segments are used, but '
+                         f'the Reporting API allows at most {MAX_DIMENSIONS}. Dimensions cannot be split over several '
+                         f'requests, since every dimension changes the rows of the result.')
+
+    metric_groups = [request['metrics'][i:i + MAX_METRICS] for i in range(0, len(request['metrics']), MAX_METRICS)]
+    segments = request.get('segments', [])
+    segment_groups = [segments[i:i + MAX_SEGMENTS] for i in range(0, len(segments), MAX_SEGMENTS)] or [None]
+    if len(metric_groups) == 1 and len(segment_groups) == 1:
+        return
+
+    requests = []
+    for segment_group in segment_groups:
+        for metric_group in metric_groups:
+            sub_request = dict(request, metrics=metric_group)
+            if segment_group:
+                sub_request['segments'] = segment_group
+            if 'orderBys' in request:
+                fields = dimensions + [met['expression'] for met in metric_group]
+                sub_request['orderBys'] = [order for order in request['orderBys'] if order['fieldName'] in fields]
+                if not sub_request['orderBys']:
+                    del sub_request['orderBys']
+            requests.append(sub_request)
+    body_obj.body['reportRequests'] = requests
+
+
+def set_date_ranges(body: dict, date_ranges: list):
+    '''
+    Set the date ranges of every request in a body. Requests of a split Body always share their date ranges.
+    '''
+    for request in body['reportRequests']:
+        request['dateRanges'] = date_ranges
+
 
 def _add_name(body_obj):
     body_obj.name = body_obj.report['query_name']
@@ -152,39 +226,33 @@ def _add_filters(body_obj):
     metric_filters = []
 
     for filter_ in filters:
-        found = False
-        for f in list(expressions['Dimension'].keys()) + list(expressions['Metric'].keys()):
-            splitted = filter_.split(f)
-            if len(splitted) > 1:
-                name = splitted[0]
-                op = f
-                exp = splitted[1]
-                if 'ga:dimension' in name:
-                    type_ = 'Dimension'
-                elif 'ga:metric' in name:
-                    type_ = 'Metric'
-                else:
-                    names = body_obj.name_client.get_names(name.strip())[0]
-                    type_ = names['type']
-                    name = names['apicode']
-
-                op = expressions[type_][op]
-
-                if 'NOT' in op:
-                    op = op.split('|')[0]
-                    NOT = True
-                else:
-                    NOT = False
-
-                if type_ == 'Dimension':
-                    dimension_filters.append([name, op, NOT, exp])
-                else:
-                    metric_filters.append([name, op, NOT, exp])
-                found = True
-                break
-
-        if not found:
+        match = FILTER_PATTERN.match(filter_)
+        if not match:
             warnings.warn(f'Filter expression {filter_} could not be processed. No matching operator found.')
+            continue
+
+        name, op, exp = match.groups()
+        if 'ga:dimension' in name:
+            type_ = 'Dimension'
+        elif 'ga:metric' in name:
+            type_ = 'Metric'
+        else:
+            names = body_obj.name_client.get_names(name.strip())[0]
+            type_ = 'Dimension' if 'Dimension' in names['type'] else 'Metric'
+            name = names['apicode']
+
+        op = expressions[type_][op]
+
+        if 'NOT' in op:
+            op = op.split('|')[0]
+            NOT = True
+        else:
+            NOT = False
+
+        if type_ == 'Dimension':
+            dimension_filters.append([name, op, NOT, exp])
+        else:
+            metric_filters.append([name, op, NOT, exp])
 
     dim_filters = [{'filters': []}]
     if len(dimension_filters) > 1:
@@ -223,7 +291,7 @@ def _add_page_size(body_obj):
         warnings.warn('Page size too large, must be <= 100.000. Setting page size for query to 100.000', UserWarning)
         body_obj.body['reportRequests'][0]['pageSize'] = 100000
     elif body_obj.report['page_size'] <= 0:
-        warnings.warn('Page size not specified or negative. Using built-in default page size of 1.000', UserWarning)
+        warnings.warn('Page size not specified or negative. Using the maximum page size of 100.000', UserWarning)
     else:
         body_obj.body['reportRequests'][0]['pageSize'] = body_obj.report['page_size']
 
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import pandas as pd
+
+SETTLE_DAYS = 3
+
+
+def body_hash(body: dict, **options) -> str:
+    '''
+    Create a stable hash of a request body and any extra options that change the result. The page token is left
+    out, since it only points to a part of the same report.
+    '''
+    body = json.loads(json.dumps(body, default=str))
+    for request in body['reportRequests']:
+        request.pop('pageToken', None)
+    canonical = json.dumps({'body': body, **options}, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ReportCache:
+    def __init__(self, max_bytes: int = 256 * 1024 ** 2, directory: str = None, ttl: int = 3600,
+                 settle_days: int = SETTLE_DAYS):
+        '''
+        Two-tier cache for report results. Results are kept in memory up to max_bytes, and optionally stored on
+        disk so later runs and other processes can reuse them. Days which ended more than settle_days ago are
+        considered closed in Google Analytics, so results fetched after that never expire. Results for more recent
+        days expire after ttl seconds.
+
+        :param max_bytes: [optional] Memory budget in bytes for the in-memory tier. Default: 256 MB.
+            Use 0 to disable the in-memory tier.
+        :param directory: [optional] Directory for the on-disk tier. If not specified, results are only cached in
+            memory.
+        :param ttl: [optional] Seconds a result for a recent day stays valid. Default: 3600.
+        :param settle_days: [optional] Amount of days after which Google Analytics data is considered final.
+            Default: 3.
+        '''
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.ttl = ttl
+        self.settle_days = settle_days
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(body: dict, date_range: dict, resource_quota: bool, sampling: str) -> str:
+        '''
+        Create a canonical hash for a single date range of a request body. The page token and the live API
+        service are not part of the key, so the same report hits the cache across Query instances.
+        '''
+        return ReportCache.keys(body, resource_quota, sampling, [date_range])[0]
+
+    @staticmethod
+    def keys(body: dict, resource_quota: bool, sampling: str, date_ranges: list = None) -> List[str]:
+        '''
+        Create the keys for all date ranges of a request body at once. The request without its date ranges is hashed
+        only once, and combined with every date range.
+        '''
+        if date_ranges is None:
+            date_ranges = body['reportRequests'][0]['dateRanges']
+        return ReportCache.range_keys(ReportCache.request_hash(body), resource_quota, sampling, date_ranges)
+
+    @staticmethod
+    def request_hash(body: dict) -> str:
+        '''
+        Hash a request body without its date ranges. Body stores this hash when its template is compiled, so the
+        keys of every request for the Body are created without serializing the request again.
+        '''
+        requests = [{field: value for field, value in request.items() if field != 'dateRanges'}
+                    for request in body['reportRequests']]
+        return body_hash(dict(body, reportRequests=requests))
+
+    @staticmethod
+    def range_keys(request_hash: str, resource_quota: bool, sampling: str, date_ranges: list) -> List[str]:
+        '''
+        Create the keys for the date ranges of a request from the hash of the request without its date ranges.
+        '''
+        base = f'{request_hash}|{resource_quota}|{sampling}|'
+        return [hashlib.sha256(f'{base}{date_range["startDate"]}|{date_range["endDate"]}'.encode('utf-8')).hexdigest()
+                for date_range in date_ranges]
+
+    def get(self, key: str, date_range: dict) -> Optional[pd.DataFrame]:
+        with self._lock:
+            if key in self._memory:
+                df, stored_at, _ = self._memory[key]
+                if self._is_valid(date_range, stored_at):
+                    self._memory.move_to_end(key)
+                    return df.copy()
+                self._evict(key)
+
+        path = self._path(key)
+        if path and os.path.exists(path):
+            # Another thread or process can remove or replace an expired file at the same time.
+            try:
+                stored_at = os.path.getmtime(path)
+                if self._is_valid(date_range, stored_at):
+                    df = pd.read_pickle(path)
+                    self._remember(key, df, stored_at)
+                    return df.copy()
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return None
+
+    def put(self, key: str, df: pd.DataFrame):
+        df = df.copy()
+        stored_at = time.time()
+        path = self._path(key)
+        if path:
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            df.to_pickle(tmp_path)
+            os.replace(tmp_path, path)
+        self._remember(key, df, stored_at)
+
+    def clear(self):
+        '''
+        Remove all cached results from memory and disk.
+        '''
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        if self.directory:
+            for file in os.listdir(self.directory):
+                if file.endswith('.pkl'):
+                    os.remove(os.path.join(self.directory, file))
+
+    def _remember(self, key, df, stored_at):
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._evict(key)
+            self._memory[key] = (df, stored_at, size)
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_bytes:
+                self._evict(next(iter(self._memory)))
+
+    def _evict(self, key):
+        _, _, size = self._memory.pop(key)
+        self._memory_bytes -= size
+
+    def _path(self, key):
+        if not self.directory:
+            return None
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def _is_valid(self, date_range, stored_at):
+        try:
+            end = datetime.strptime(date_range['endDate'], '%Y-%m-%d')
+        except ValueError:
+            # Relative dates such as 'yesterday' or '7daysAgo' shift every day.
+            return time.time() - stored_at < self.ttl
+        settled_at = end + timedelta(days=self.settle_days + 1)
+        if stored_at >= settled_at.timestamp():
+            return True
+        return time.time() - stored_at < self.ttl
@@ -1,27 +1,123 @@
 import warnings
 from datetime import datetime, timedelta
-from typing import Union
+from typing import Callable, List, Union
+
+import numpy as np
+import pandas as pd
 
 '''
-Module to create dynamic date ranges for Google Analytys queries. 
+Module to create dynamic date ranges for Google Analytys queries. Relative ranges like LAST_7_DAYS are DateRange
+objects, which are computed from the current date every time they are used.
 '''
 
+# Pandas period of every chunking strategy. Weeks run from Monday to Sunday.
+CHUNKINGS = {
+    'day': 'D',
+    'week': 'W',
+    'month': 'M'
+}
+
+
 def c(dates):
     return [dates[0].replace(hour=0, minute=0, second=0, microsecond=0),
             dates[1].replace(hour=0, minute=0, second=0, microsecond=0)]
 
 
-TODAY = datetime.now()
-YESTERDAY = c([TODAY - timedelta(days=1), TODAY - timedelta(days=1)])
-LAST_WEEK = c([TODAY - timedelta(days=TODAY.weekday(), weeks=1),
-             TODAY - timedelta(days=TODAY.weekday(), weeks=1) + timedelta(days=6)])
-LAST_7_DAYS = c([YESTERDAY[0] - timedelta(days=7), YESTERDAY[0]])
-THIS_MONTH = c([TODAY.replace(day=1), YESTERDAY[0]])
-LAST_MONTH = c([(TODAY.replace(day=1) - timedelta(days=1)).replace(day=1),
-              TODAY.replace(day=1) - timedelta(days=1)])
-LAST_90_DAYS = c([TODAY - timedelta(days=91), YESTERDAY[0]])
-LAST_YEAR = c([datetime(TODAY.year - 1, 1, 1), datetime(TODAY.year - 1, 12, 31)])
-THIS_YEAR = c([datetime(TODAY.year, 1, 1), YESTERDAY[0]])
+class DateRange:
+    def __init__(self, start: Union[str, datetime, Callable[[], list]], end: Union[str, datetime] = None):
+        '''
+        Date range which is resolved every time it is used, so relative ranges stay correct in processes that run
+        for days. Can be used everywhere a list of a start and end date is accepted, e.g. as the date_range of a
+        Body.
+
+        :param start: Start date as a datetime or a string in the form 'YYYY-MM-DD', or a function without
+            parameters which returns a list of the start and end date.
+        :param end: End date as a datetime or a string in the form 'YYYY-MM-DD'. Not used when start is a function.
+        '''
+        if callable(start):
+            self._resolve = start
+        elif end is None:
+            raise ValueError('An end date is needed when the start of a DateRange is a date.')
+        else:
+            self._resolve = lambda: [start, end]
+
+    def __repr__(self):
+        start, end = self.resolve()
+        return f'DateRange({start:%Y-%m-%d}, {end:%Y-%m-%d})'
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __getitem__(self, item):
+        return self.resolve()[item]
+
+    def __len__(self):
+        return 2
+
+    def resolve(self) -> list:
+        '''
+        Return the start and end date of the range as datetime objects.
+        '''
+        return c([_to_datetime(date) for date in self._resolve()])
+
+    def days(self) -> List[str]:
+        '''
+        Return every day in the range as a string in the form 'YYYY-MM-DD', from the earliest to the latest day.
+        '''
+        start, end = sorted(self.resolve())
+        return pd.date_range(start, end).strftime('%Y-%m-%d').tolist()
+
+    def chunks(self, chunking: str = 'day') -> List[List[str]]:
+        '''
+        Return the days in the range grouped per day, per week or per month, see chunk_days().
+        '''
+        return chunk_days(self.days(), chunking)
+
+
+def chunk_days(days: List[str], chunking: str = 'day') -> List[List[str]]:
+    '''
+    Group consecutive days per day, per week (Monday to Sunday) or per calendar month. The first and last chunk only
+    hold the days that are in the list.
+
+    :param days: List of consecutive days in the form 'YYYY-MM-DD'.
+    :param chunking: [optional] 'day', 'week' or 'month'. Default: 'day'.
+    '''
+    if chunking not in CHUNKINGS:
+        raise ValueError(f'{chunking} is not a valid chunking. Use one of: {", ".join(CHUNKINGS)}.')
+    if chunking == 'day' or not days:
+        return [[day] for day in days]
+    periods = pd.DatetimeIndex(days).to_period(CHUNKINGS[chunking]).asi8
+    return [chunk.tolist() for chunk in np.split(np.array(days, dtype=object), np.flatnonzero(np.diff(periods)) + 1)]
+
+
+def _to_datetime(date) -> datetime:
+    if type(date) == str:
+        return datetime.strptime(date, '%Y-%m-%d')
+    return pd.Timestamp(date).to_pydatetime()
+
+
+def _relative(func: Callable[[datetime], list]) -> DateRange:
+    # func receives the current time whenever the range is used.
+    return DateRange(lambda: func(datetime.now()))
+
+
+def __getattr__(name):
+    # TODAY is the time of access, instead of the time the module was imported.
+    if name == 'TODAY':
+        return datetime.now()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+YESTERDAY = _relative(lambda today: [today - timedelta(days=1), today - timedelta(days=1)])
+LAST_WEEK = _relative(lambda today: [today - timedelta(days=today.weekday(), weeks=1),
+                                     today - timedelta(days=today.weekday(), weeks=1) + timedelta(days=6)])
+LAST_7_DAYS = _relative(lambda today: [today - timedelta(days=8), today - timedelta(days=1)])
+THIS_MONTH = _relative(lambda today: [today.replace(day=1), today - timedelta(days=1)])
+LAST_MONTH = _relative(lambda today: [(today.replace(day=1) - timedelta(days=1)).replace(day=1),
+                                      today.replace(day=1) - timedelta(days=1)])
+LAST_90_DAYS = _relative(lambda today: [today - timedelta(days=91), today - timedelta(days=1)])
+LAST_YEAR = _relative(lambda today: [datetime(today.year - 1, 1, 1), datetime(today.year - 1, 12, 31)])
+THIS_YEAR = _relative(lambda today: [datetime(today.year, 1, 1), today - timedelta(days=1)])
 
 
 def quarter(q_num: int, year: int) -> list:
@@ -31,23 +127,25 @@ def quarter(q_num: int, year: int) -> list:
     :param year: Year as an int
     :return: List of length 2 containing the start and end date of the quarter as a datetime object.
     '''
+    today = datetime.now()
+    yesterday = (today - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
     q_lookup = {
-        1: [datetime(TODAY.year, 1, 1), datetime(TODAY.year, 3, 31)],
-        2: [datetime(TODAY.year, 4, 1), datetime(TODAY.year, 6, 30)],
-        3: [datetime(TODAY.year, 7, 1), datetime(TODAY.year, 9, 30)],
-        4: [datetime(TODAY.year, 10, 1), datetime(TODAY.year, 12, 31)]
+        1: [datetime(today.year, 1, 1), datetime(today.year, 3, 31)],
+        2: [datetime(today.year, 4, 1), datetime(today.year, 6, 30)],
+        3: [datetime(today.year, 7, 1), datetime(today.year, 9, 30)],
+        4: [datetime(today.year, 10, 1), datetime(today.year, 12, 31)]
     }
     if q_num == 0:
-        diffs = {num: TODAY - date_[0] for num, date_ in q_lookup.items() if
-                 TODAY - date_[0] > timedelta(days=0)}
+        diffs = {num: today - date_[0] for num, date_ in q_lookup.items() if
+                 today - date_[0] > timedelta(days=0)}
         current_quarter = list(diffs.values()).index(min(diffs.values())) + 1
-        return [q_lookup[current_quarter][0], YESTERDAY[0]]
+        return [q_lookup[current_quarter][0], yesterday]
 
     if q_num == -1:
-        diffs = {num: TODAY - date_[0] for num, date_ in q_lookup.items() if
-                 TODAY - date_[0] > timedelta(days=0)}
+        diffs = {num: today - date_[0] for num, date_ in q_lookup.items() if
+                 today - date_[0] > timedelta(days=0)}
         current_quarter = list(diffs.values()).index(min(diffs.values())) + 1
-        year = TODAY.year
+        year = today.year
         if current_quarter == 1:
             q_num = 4
             year -= 1
@@ -55,43 +153,43 @@ def quarter(q_num: int, year: int) -> list:
             q_num = current_quarter - 1
 
     q = q_lookup[q_num]
-    if year != TODAY.year:
+    if year != today.year:
         q = [d.replace(year=year) for d in q]
 
-    if q[0] > TODAY and q[1] > TODAY:
+    if q[0] > today and q[1] > today:
         raise UserWarning(
             f'Dates for Q{q_num} of {year} are in the future and will not yield any results in Google Analytics.')
 
-    elif q[1] > TODAY:
+    elif q[1] > today:
         warnings.warn(f'Q{q_num} of {year} is the current quarter. Date range will end yesterday.')
-        q[1] = YESTERDAY[0]
+        q[1] = yesterday
 
     return c(q)
 
 
-LAST_QUARTER = quarter(-1, TODAY.year)
-CURRENT_QUARTER = quarter(0, TODAY.year)
+LAST_QUARTER = _relative(lambda today: quarter(-1, today.year))
+CURRENT_QUARTER = _relative(lambda today: quarter(0, today.year))
 
 
-def last_weeks(week_amount: int, full_week: bool = True, first_day: str = 'mon') -> list:
+def last_weeks(week_amount: int, full_week: bool = True, first_day: str = 'mon') -> DateRange:
     days_calc = {'tue': 1, 'wed': 2, 'thu': 3, 'fri': -3, 'sat': -2, 'sun': -1, 'mon': 0}
     try:
         shift_day = timedelta(days=days_calc[first_day])
     except KeyError:
         raise ValueError(f'{first_day} is not a valid option for the first_day parameter.')
 
-    if not full_week:
-        first_day_in_range = datetime.now() - timedelta(weeks=week_amount)
-        last_day_in_range = datetime.now() - timedelta(days=1)
-    else:
-        first_day_in_range = datetime.now() - timedelta(days=datetime.now().weekday()) - timedelta(weeks=week_amount + 1) + shift_day
-        last_day_in_range = datetime.now() - timedelta(days=datetime.now().weekday()) - timedelta(days=1) + shift_day
+    def resolve(today):
+        if not full_week:
+            return [today - timedelta(weeks=week_amount), today - timedelta(days=1)]
+        week_start = today - timedelta(days=today.weekday())
+        return [week_start - timedelta(weeks=week_amount + 1) + shift_day,
+                week_start - timedelta(days=1) + shift_day]
 
-    return c([first_day_in_range, last_day_in_range])
+    return _relative(resolve)
 
 
-def last_days(day_amount: int) -> list:
-    return c([YESTERDAY[0] - timedelta(days=day_amount + 1), YESTERDAY[0]])
+def last_days(day_amount: int) -> DateRange:
+    return _relative(lambda today: [today - timedelta(days=day_amount + 2), today - timedelta(days=1)])
 
 
 def weeks(week: Union[int, tuple, list], year: int, first_day: str = 'mon') -> list:
@@ -120,24 +218,26 @@ def weeks(week: Union[int, tuple, list], year: int, first_day: str = 'mon') -> l
 
     date_range = [first_day_of_week, last_day_of_week]
 
-    if date_range[0] > TODAY and date_range[1] > TODAY:
+    today = datetime.now()
+    if date_range[0] > today and date_range[1] > today:
         raise UserWarning(
             f'Week given date range is in the future and will not yield any '
             f'results in Google Analytics.')
-    elif date_range[1] > TODAY:
+    elif date_range[1] > today:
         warnings.warn(f'Week {week[1]} is (partially) in the future. The end date will be set to yesterday.',
                       UserWarning)
-        date_range[1] = YESTERDAY[0]
+        date_range[1] = today - timedelta(days=1)
 
     return c(date_range)
 
 
-def combine_ranges(*ranges):
-    new_range = list(set(item for sublist in ranges for item in sublist))
-    start = min(new_range)
-    end = max(new_range)
-    return c([start, end])
-
-
-
+def combine_ranges(*ranges) -> DateRange:
+    '''
+    Combine date ranges into one range from the earliest to the latest date. Relative ranges are resolved every time
+    the combined range is used.
+    '''
+    def resolve():
+        new_range = [_to_datetime(item) for sublist in ranges for item in sublist]
+        return [min(new_range), max(new_range)]
 
+    return DateRange(resolve)
@@ -0,0 +1,55 @@
+import os
+import pickle
+import sqlite3 as db
+from typing import Set
+
+import pandas as pd
+
+
+class RunJournal:
+    def __init__(self, path: str = 'partial_results.db'):
+        '''
+        Journal of the days a Query has completed, so a failed run can be resumed without requesting those days
+        again. All writes go through a single connection in WAL mode.
+
+        :param path: [optional] Path of the SQLite file. Default: partial_results.db in the working directory.
+        '''
+        self.path = path
+        self.conn = db.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS journal '
+                          '(run_key TEXT, date TEXT, result BLOB, PRIMARY KEY (run_key, date))')
+        self.conn.commit()
+
+    def completed(self, run_key: str) -> Set[str]:
+        '''
+        Return the dates that were completed for a run.
+        '''
+        rows = self.conn.execute('SELECT date FROM journal WHERE run_key = ?', (run_key,)).fetchall()
+        return {row[0] for row in rows}
+
+    def result(self, run_key: str, date: str) -> pd.DataFrame:
+        row = self.conn.execute('SELECT result FROM journal WHERE run_key = ? AND date = ?',
+                                (run_key, date)).fetchone()
+        return pickle.loads(row[0])
+
+    def record(self, run_key: str, date: str, result: pd.DataFrame):
+        self.conn.execute('INSERT OR REPLACE INTO journal VALUES (?, ?, ?)',
+                          (run_key, date, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.conn.commit()
+
+    def clear(self, run_key: str):
+        self.conn.execute('DELETE FROM journal WHERE run_key = ?', (run_key,))
+        self.conn.commit()
+
+    def close(self):
+        '''
+        Close the connection. The file is removed when no run has days left in the journal.
+        '''
+        empty = self.conn.execute('SELECT COUNT(*) FROM journal').fetchone()[0] == 0
+        self.conn.close()
+        if empty:
+            for path in [self.path, self.path + '-wal', self.path + '-shm']:
+                if os.path.exists(path):
+                    os.remove(path)
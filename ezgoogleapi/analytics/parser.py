@@ -0,0 +1,199 @@
+import json
+from itertools import chain
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from ezgoogleapi.common.exceptions import SamplingError
+
+METRIC_TYPES = {
+    'INTEGER': np.int64,
+    'FLOAT': np.float64,
+    'PERCENT': np.float64,
+    'TIME': np.float64,
+    'CURRENCY': np.float64
+}
+
+DATE_FORMATS = {
+    'ga:date': '%Y%m%d',
+    'ga:dateHour': '%Y%m%d%H',
+    'ga:dateHourMinute': '%Y%m%d%H%M'
+}
+
+
+class ReportParser:
+    def __init__(self, column_header: dict):
+        '''
+        Collects the rows of a report column by column over all of its pages and builds a typed DataFrame.
+        Metrics are converted according to their type in the column header, dimensions are stored as categoricals
+        and ga:date, ga:dateHour and ga:dateHourMinute are parsed to datetime64.
+
+        :param column_header: The columnHeader of a report in the Reporting API response.
+        '''
+        self.dimensions = column_header.get('dimensions', [])
+        self.metrics = [(entry['name'], entry.get('type')) for entry in
+                        column_header['metricHeader']['metricHeaderEntries']]
+        self.columns = [[] for _ in range(len(self.dimensions) + len(self.metrics))]
+
+    def add(self, rows: list, index: int = 0, range_count: int = 1):
+        '''
+        Add a page of rows for the date range at the given index. When a request holds more than one date range,
+        rows without any value for this date range are left out.
+        '''
+        if range_count > 1:
+            rows = [row for row in rows if any(float(value) for value in row['metrics'][index]['values'])]
+        if not rows:
+            return
+        dimension_columns = zip(*[row['dimensions'] for row in rows]) if self.dimensions else []
+        metric_columns = zip(*[row['metrics'][index]['values'] for row in rows])
+        for column, values in zip(self.columns, chain(dimension_columns, metric_columns)):
+            column.extend(values)
+
+    def to_frame(self) -> pd.DataFrame:
+        data = {}
+        for name, values in zip(self.dimensions, self.columns):
+            if name in DATE_FORMATS:
+                data[name] = pd.to_datetime(values, format=DATE_FORMATS[name])
+            else:
+                data[name] = pd.Categorical(values)
+        for (name, type_), values in zip(self.metrics, self.columns[len(self.dimensions):]):
+            if type_ in METRIC_TYPES:
+                data[name] = np.array(values).astype(METRIC_TYPES[type_])
+            else:
+                data[name] = np.array(values, dtype=object)
+        return pd.DataFrame(data)
+
+
+class ResourceQuotaRetry(Exception):
+    pass
+
+
+class ReportReader:
+    def __init__(self, body: dict, resource_quota: bool, sampling: str):
+        '''
+        Reads the pages of a report request in order, applies the sampling option and returns one typed DataFrame
+        per date range. Shared by Query and AsyncQuery, which only differ in how the pages are requested.
+
+        :param body: The request body, used for the date ranges and to check whether resource quota is used.
+        :param resource_quota: Whether to retry sampled requests with resource quota.
+        :param sampling: 'fail', 'skip', 'save' or 'split'.
+        '''
+        self.date_ranges = body['reportRequests'][0]['dateRanges']
+        self.date = ', '.join(date_range['startDate'] for date_range in self.date_ranges)
+        self.retry_quota = resource_quota and 'useResourceQuotas' not in body.keys()
+        self.sampling = sampling
+        self.parsers = []
+        self.sample_sizes = [None for _ in self.date_ranges]
+
+    def add(self, report: dict) -> bool:
+        '''
+        Process one page. Returns False when the remaining pages are not needed. Raises ResourceQuotaRetry when the
+        request has to be sent again with resource quota, and SamplingError when sampling is not allowed.
+        '''
+        if not self.parsers:
+            self.parsers = [ReportParser(report['columnHeader']) for _ in self.date_ranges]
+        report_data = report['data']
+
+        try:
+            rows = report_data['rows']
+        except KeyError:
+            return True
+
+        if is_sampled(report_data):
+            self.sample_sizes = [int(read) / int(space) if int(read) < int(space) else None for read, space in
+                                 zip(report_data['samplesReadCounts'], report_data['samplingSpaceSizes'])]
+            sample_size = min(size for size in self.sample_sizes if size is not None)
+            if self.retry_quota:
+                raise ResourceQuotaRetry()
+            elif self.sampling == 'save':
+                percentage = round(sample_size * 100, 1)
+                print(f'{self.date} contains sampled data: {percentage}%')
+            elif self.sampling in ('fail', 'split'):
+                raise SamplingError(sample_size)
+            else:
+                """skip"""
+                print(f'{self.date} contains sampled data and will not be available in the results')
+                if None not in self.sample_sizes:
+                    return False
+
+        for i, parser in enumerate(self.parsers):
+            parser.add(rows, i, len(self.date_ranges))
+        return True
+
+    def results(self) -> List[pd.DataFrame]:
+        results = [parser.to_frame() for parser in self.parsers] or [pd.DataFrame() for _ in self.date_ranges]
+        for i, sample_size in enumerate(self.sample_sizes):
+            if sample_size is None:
+                continue
+            if self.sampling == 'skip':
+                results[i] = pd.DataFrame()
+            else:
+                results[i]['Sampling'] = sample_size
+        return results
+
+
+def is_sampled(report_data: dict) -> bool:
+    if 'samplesReadCounts' not in report_data.keys():
+        return False
+    return any(int(read) < int(space) for read, space in
+               zip(report_data['samplesReadCounts'], report_data['samplingSpaceSizes']))
+
+
+def concat_results(results: List[pd.DataFrame]) -> pd.DataFrame:
+    '''
+    Concatenate results while keeping categorical columns categorical, by giving them the same categories first.
+    '''
+    results = [result for result in results if not result.empty] or results[:1]
+    if len(results) > 1:
+        for col in results[0].columns:
+            if not all(col in result.columns and isinstance(result[col].dtype, pd.CategoricalDtype)
+                       for result in results):
+                continue
+            categories = pd.api.types.union_categoricals([result[col] for result in results]).categories
+            results = [result.assign(**{col: result[col].cat.set_categories(categories)}) for result in results]
+    return pd.concat(results)
+
+
+def split_body(body: dict) -> List[dict]:
+    '''
+    Return a separate body for every request of a split Body. Every body has its own copy of the request, which may
+    be changed while it is sent.
+    '''
+    return [dict(body, reportRequests=[dict(request)]) for request in body['reportRequests']]
+
+
+def join_results(requests: List[dict], results: List[List[pd.DataFrame]]) -> List[pd.DataFrame]:
+    '''
+    Join the results of the requests of a split Body back together, per date range. Requests for the same segments
+    hold other metrics for the same rows and are joined on the dimension columns. Requests for other segments hold
+    other rows and are appended.
+    '''
+    keys = [dim['name'] for dim in requests[0]['dimensions']]
+    groups = {}
+    for request, ranges in zip(requests, results):
+        groups.setdefault(json.dumps(request.get('segments')), []).append(ranges)
+    return [concat_results([_join_frames([ranges[i] for ranges in group], keys) for group in groups.values()])
+            for i in range(len(results[0]))]
+
+
+def _join_frames(frames: List[pd.DataFrame], keys: List[str]) -> pd.DataFrame:
+    # A result without columns was skipped because of sampling, so the joined result is not available either.
+    if any(len(frame.columns) == 0 for frame in frames):
+        return pd.DataFrame()
+    joined = frames[0]
+    for frame in frames[1:]:
+        joined = joined.merge(frame, how='outer', on=keys, suffixes=('', ' joined'))
+        if 'Sampling joined' in joined.columns:
+            joined['Sampling'] = joined[['Sampling', 'Sampling joined']].min(axis=1)
+            joined = joined.drop(columns='Sampling joined')
+
+    # Rows are left out of a report when all of its metrics are 0, so missing values after the join are 0.
+    dtypes = {col: dtype for frame in frames for col, dtype in frame.dtypes.items()}
+    for col in joined.columns:
+        if col in keys:
+            if isinstance(dtypes[col], pd.CategoricalDtype):
+                joined[col] = joined[col].astype('category')
+        elif col != 'Sampling' and joined[col].isna().any():
+            joined[col] = joined[col].fillna(0).astype(dtypes[col])
+    return joined.reset_index(drop=True)
@@ -1,48 +1,78 @@
 import json
 import pathlib
-import string
+import pickle
 import time
+import warnings
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from functools import lru_cache
-from typing import Any, List, Callable
-import sqlite3 as db
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+from typing import Any, List, Callable, Optional, Iterator, Tuple, Type, Union
 import pandas as pd
 import os
+from ezgoogleapi.analytics.cache import ReportCache, SETTLE_DAYS, body_hash
+from ezgoogleapi.analytics.daterange import CHUNKINGS, DateRange, chunk_days
+from ezgoogleapi.analytics.journal import RunJournal
+from ezgoogleapi.analytics.parser import ReportReader, ResourceQuotaRetry, concat_results, join_results, split_body
+from ezgoogleapi.analytics.sinks import CsvSink, SqliteSink, _BackgroundSink, _clean_columns
 from ezgoogleapi.analytics.variable_names import VariableName
+from ezgoogleapi.common.connections import get_service
 from ezgoogleapi.common.exceptions import SamplingError
 
 BASE_DIR = os.getcwd()
 DIR = str(pathlib.Path(__file__).parent)
 SCOPES = ['https://www.googleapis.com/auth/analytics.readonly']
+MAX_WORKERS = 10
+MAX_DATE_RANGES = 2
+MAX_PAGE_SIZE = 100000
+RETRIES = 3
+DEFAULT_CACHE = ReportCache()
 
 
 def initialize_analyticsreporting(keyfile) -> Any:
-    credentials = Credentials.from_service_account_file(keyfile, scopes=SCOPES)
-    analytics = build('analyticsreporting', 'v4', credentials=credentials)
-    return analytics
+    return get_service('analyticsreporting', 'v4', keyfile, SCOPES)
 
 
-# TODO: socket timeout op requests afvangen
 class Query:
-    def __init__(self, body, keyfile: str, clean_up: Callable = None):
+    def __init__(self, body, keyfile: str, clean_up: Callable = None, cache: ReportCache = None,
+                 journal: str = 'partial_results.db'):
         '''
         Class to run queries for a given Body object.
 
         :param body: ezgoogleapi.analytics.Body object
         :param keyfile: JSON keyfile name in the form "file_name.json".
+        :param cache: [optional] ReportCache object to reuse results from earlier runs. If not specified, results
+            are shared through an in-memory cache for the lifetime of the process.
+        :param journal: [optional] Path of the run journal used to resume per_day runs. Default: partial_results.db
         '''
-        self.analytics = initialize_analyticsreporting(keyfile)
+        self.keyfile = keyfile
+        self.analytics = self._connect(keyfile)
         self.body = body
         self.resource_quota = self.body.resource_quota
-        self.date_range = calc_range(*body.date_range)
+        self.date_range = body.date_range
         self.name_client = VariableName()
         self.sampling_report = []
         self.results = []
         self.clean_up_func = clean_up
+        self.cache = cache if cache is not None else DEFAULT_CACHE
+        self.journal_path = journal
+        self._page_workers = MAX_WORKERS
 
-    def run(self, per_day=True, sampling='fail', clean_headers=False, logging=True):
+    @property
+    def date_range(self) -> List[str]:
+        '''
+        Every day in the date range of the query. Relative ranges like LAST_7_DAYS are resolved on every access.
+        '''
+        return self._date_range.days()
+
+    @date_range.setter
+    def date_range(self, date_range):
+        if not isinstance(date_range, DateRange):
+            date_range = DateRange(date_range[0], date_range[-1])
+        self._date_range = date_range
+
+    def run(self, per_day=True, sampling='fail', clean_headers=False, logging=True, workers: int = 1,
+            pack_days: bool = False, resume: bool = False, adaptive: bool = False, chunking: str = None,
+            processes: int = 0):
         '''
         Execute API requests for given body and given date range. Saves result to Query.results,
         which can be exported to csv, dataframe and sqlite.
@@ -51,45 +81,283 @@ class Query:
         :param clean_headers: [optional] Specify whether to use the Google Ananlytics variable name e.g. Device
             Category or the API code ga:deviceCategory
         :param per_day: Default True.
-            Execute queries per day. Reduces chance of sampling.
+            Execute queries per day. Reduces chance of sampling. Same as chunking='day'.
         :param sampling: Default 'fail'.
             Specify what to do when sampled results are encountered. Options: 'fail' (generate error), 'skip'
             (do not generate error), 'save' (save the record as normal, and include column with sample percentage).
+        :param workers: Default 1.
+            Amount of chunks fetched in parallel when the date range is chunked. Capped at 10, the amount of
+            concurrent requests Google Analytics allows per view. Results are still saved in date order.
+        :param pack_days: Default False.
+            Request two chunks at once when the date range is chunked, using both date range slots of a single report
+            request. Halves the amount of requests, but sampling is evaluated over both chunks together.
+        :param resume: Default False.
+            Continue a chunked run that stopped because of an error or sampling. Chunks which were completed by the
+            earlier run with the same body are loaded from the run journal instead of being requested again. The
+            sampling option may differ from the earlier run.
+        :param adaptive: Default False.
+            Same as chunking='adaptive'.
+        :param chunking: [optional] How the date range is split into requests. Overrides per_day and adaptive.
+            'day': one request per day.
+            'week': one request per week, Monday to Sunday.
+            'month': one request per calendar month.
+            'adaptive': request the full date range first and only split the parts that come back sampled in half,
+            down to single days.
+            Longer chunks need far fewer requests, but are more likely to be sampled. Every chunk gives one result,
+            so add the ga:date dimension to keep the rows per day.
+        :param processes: Default 0.
+            Amount of processes that apply the clean_up function, while the next chunks are being fetched. Useful
+            when the clean_up function is slow. The function has to be defined at module level, so it can be sent to
+            the processes. With 0, the clean_up function runs in the main thread.
         '''
+        for result in self.iter_results(per_day, sampling, clean_headers, logging, workers, pack_days, resume,
+                                        adaptive, chunking, processes):
+            self.results.append(result)
 
-        if per_day:
-            for date in self.date_range:
-                body = self.body.body
-                body['reportRequests'][0]['dateRanges'] = [{'startDate': date, 'endDate': date}]
-                result = get_report(json.dumps(body), self.analytics, self.resource_quota, sampling)
-                if logging:
-                    print(f'Result for date {date} contains {len(result)} rows')
-                if clean_headers:
-                    result.columns = self.name_client.get_names(list(result.columns), return_type='name')
-                if self.clean_up_func:
-                    result = self.clean_up_func(result)
-                self.results.append(result)
-                with db.connect('partial_results.db') as conn:
-                    try:
-                        result.to_sql('results', con=conn, index=False, if_exists='append')
-                    except db.OperationalError:
-                        pass
-                        # TODO: toevoegen error handling
-
-                conn.close()
-                time.sleep(0.5)
-            os.remove('partial_results.db')
+    def iter_results(self, per_day=True, sampling='fail', clean_headers=False, logging=True, workers: int = 1,
+                     pack_days: bool = False, resume: bool = False, adaptive: bool = False,
+                     chunking: str = None, processes: int = 0) -> Iterator[pd.DataFrame]:
+        '''
+        Execute the queries like Query.run(), but yield the result of every chunk as soon as it arrives instead of
+        saving it to Query.results. At most a few chunks per worker are kept in memory at any time. Takes the same
+        parameters as Query.run().
+
+        >> for df in query.iter_results(workers=4):
+        >>     print(len(df))
+        '''
+        workers = _check_workers(workers)
+        self._page_workers = max(1, MAX_WORKERS // workers)
+        chunking = _check_chunking(chunking, per_day, adaptive)
+        dates = self.date_range
+        if chunking == 'adaptive':
+            fetched = _logged(self._fetch_adaptive(dates, sampling, logging), logging)
+            yield from self._transform(fetched, clean_headers, processes)
+
+        elif chunking:
+            # sampling is not part of the key, so a run stopped by a SamplingError can be resumed with 'skip' or
+            # 'save'. The chunks completed under 'fail' are unsampled.
+            run_key = body_hash(self.body.body, clean_headers=clean_headers, chunking=chunking)
+            journal = RunJournal(self.journal_path)
+            done = set()
+            if resume:
+                done = journal.completed(run_key)
+                if logging and done:
+                    print(f'Resuming run, {len(done)} chunks were already completed')
+            else:
+                journal.clear(run_key)
+
+            # Chunks are recorded in the journal by their first day.
+            chunks = chunk_days(dates, chunking)
+            pending = [chunk for chunk in chunks if chunk[0] not in done]
+            fetched = self._fetch_chunks(pending, sampling, workers, pack_days)
+            transformed = self._transform(_logged(fetched, logging), clean_headers, processes)
+            try:
+                for chunk in chunks:
+                    date = chunk[0]
+                    if date in done:
+                        yield journal.result(run_key, date)
+                        continue
+                    result = next(transformed)
+                    journal.record(run_key, date, result)
+                    yield result
+            except SamplingError as err:
+                raise SamplingError(err.sample_size, self.journal_path) from None
+            else:
+                journal.clear(run_key)
+            finally:
+                transformed.close()
+                fetched.close()
+                journal.close()
 
         else:
-            body = self.body.body
-            body['reportRequests'][0]['dateRanges'] = [
-                {'startDate': self.body.date_range[0], 'endDate': self.body.date_range[1]}]
-            result = get_report(body, self.analytics, self.resource_quota, sampling)
-            if clean_headers:
-                result.columns = self.name_client.get_names(list(result.columns), return_type='name')
-            if self.clean_up_func:
-                result = self.clean_up_func(result)
-            self.results.append(result)
+            body = self.body.request([{'startDate': dates[0], 'endDate': dates[-1]}])
+            result = concat_results(self._get_report_ranges(body, sampling))
+            yield self._clean_result(result, clean_headers)
+
+    def stream(self, sink: Union[Callable[[pd.DataFrame], Any], List[Callable]], queue_size: int = 4,
+               **run_options):
+        '''
+        Execute the queries and pass the result of every chunk to a sink as soon as it arrives, without keeping the
+        results in memory. Every sink writes in its own thread, so the next chunks are fetched while a result is
+        written. Takes the same keyword arguments as Query.run().
+
+        :param sink: CsvSink, SqliteSink or any function that takes a pandas DataFrame, or a list of them.
+        :param queue_size: [optional] Amount of results that may wait for a sink. When a sink falls behind, fetching
+            pauses until it catches up. Default: 4.
+
+        >> query.stream(CsvSink('example.csv'), workers=4)
+        '''
+        sinks = [_BackgroundSink(sink, queue_size) for sink in (sink if isinstance(sink, list) else [sink])]
+        try:
+            for result in self.iter_results(**run_options):
+                for sink in sinks:
+                    sink(result)
+        finally:
+            for sink in sinks:
+                sink.close()
+
+    def refresh(self, target, unsettled_days: int = SETTLE_DAYS, date_column: str = None, **run_options):
+        '''
+        Bring a table filled by an earlier run up to date. Only the days after the latest date in the table are
+        requested, plus the last unsettled_days days before today, since Google Analytics can still change the data
+        of recent days. The rows from the first requested day onwards are replaced in the table. The body needs the
+        ga:date dimension. The results get the column names Query.to_sqlite() gives them, and the old rows are only
+        removed when the new rows are written in the same transaction or statement.
+
+        :param target: SqliteSink, or ezgoogleapi.bigquery.BigQuery object with the table set.
+        :param unsettled_days: [optional] Amount of recent days to request again, even when they are in the table.
+            Default: 3.
+        :param date_column: [optional] Name of the ga:date column in the table. Default: the name Query.to_sqlite()
+            gives the column, which is Date unless custom headers are set on the SqliteSink.
+        :param run_options: [optional] Keyword arguments for Query.run().
+
+        >> query.refresh(SqliteSink('example.db'), workers=4)
+        '''
+        plan = self._refresh_plan(target, unsettled_days, date_column, run_options.get('logging', True))
+        if plan is None:
+            return
+        # The results are renamed to the table columns, so they are requested with the API codes as headers.
+        run_options['clean_headers'] = False
+        date_range, self.date_range = self._date_range, DateRange(plan[1], self.date_range[-1])
+        try:
+            results = list(self.iter_results(**run_options))
+        finally:
+            self.date_range = date_range
+        self._replace(target, plan, results)
+
+    def _refresh_plan(self, target, unsettled_days, date_column, logging):
+        # Returns the date column and the first day to request, or None when the table is up to date.
+        if 'ga:date' not in self.body.dimensions:
+            raise ValueError('Query.refresh() needs the ga:date dimension in the body to find the latest date in the '
+                             'table.')
+        if date_column is None:
+            columns = self.body.dimensions + self.body.metrics
+            date_column = self._table_columns(target, columns)[columns.index('ga:date')]
+        first, last = self.date_range[0], self.date_range[-1]
+        start = first
+        watermark = target.watermark(date_column)
+        if watermark is not None:
+            settled = datetime.strftime(datetime.now() - timedelta(days=unsettled_days), '%Y-%m-%d')
+            start = max(first, min(datetime.strftime(watermark + timedelta(days=1), '%Y-%m-%d'), settled))
+
+        if start > last:
+            if logging:
+                print(f'Table is up to date until {last}')
+            return None
+        if logging:
+            print(f'Refreshing dates {start} to {last}')
+        return date_column, start
+
+    def _replace(self, target, plan, results):
+        date_column, start = plan
+        results = [result.set_axis(self._table_columns(target, list(result.columns)), axis=1) for result in results]
+        try:
+            target.replace_from(date_column, start, results)
+        finally:
+            if hasattr(target, 'close'):
+                target.close()
+
+    def _table_columns(self, target, columns: list) -> list:
+        # The names Query.to_sqlite() gives the columns: the headers of the sink, or the cleaned variable names.
+        headers = getattr(target, 'headers', None)
+        if headers and len(headers) == len(columns):
+            return _clean_columns(headers)
+        return _clean_columns([self.name_client.get_names(col, return_type='name')[0] if col.startswith('ga:')
+                               else col for col in columns])
+
+    def _connect(self, keyfile):
+        return initialize_analyticsreporting(keyfile)
+
+    def _chunks(self, chunks, pack_days):
+        # Returns the chunks of every request with its body, packing two chunks per request when asked.
+        request = self.body.body['reportRequests'][0]
+        size = 1
+        if pack_days:
+            if 'metricFilterClauses' in request or 'orderBys' in request:
+                warnings.warn('Metric filters and ordering only apply to the first date range of a request. Days will '
+                              'not be packed for this query.', UserWarning)
+            else:
+                size = MAX_DATE_RANGES
+
+        requests = []
+        for i in range(0, len(chunks), size):
+            packed = chunks[i:i + size]
+            requests.append((packed, self.body.request([{'startDate': chunk[0], 'endDate': chunk[-1]}
+                                                        for chunk in packed])))
+        return requests
+
+    def _fetch_chunks(self, chunks, sampling, workers, pack_days):
+        requests = self._chunks(chunks, pack_days)
+        if workers == 1:
+            for packed, body in requests:
+                results, cached = self._report_ranges(body, sampling)
+                yield from zip(packed, results)
+                if not cached:
+                    time.sleep(0.5)
+            return
+
+        def fetch(request):
+            return request[0], self._get_report_ranges(request[1], sampling, self._thread_analytics())
+
+        for packed, results in _ordered_map(fetch, requests, workers):
+            yield from zip(packed, results)
+
+    def _fetch_adaptive(self, dates, sampling, logging):
+        body = self.body.request([{'startDate': dates[0], 'endDate': dates[-1]}])
+        if len(dates) == 1:
+            yield dates, concat_results(self._get_report_ranges(body, sampling))
+            return
+
+        try:
+            result = concat_results(self._get_report_ranges(body, 'split'))
+        except SamplingError:
+            if logging:
+                print(f'Dates {dates[0]} to {dates[-1]} contain sampled data. Splitting the date range.')
+            middle = len(dates) // 2
+            yield from self._fetch_adaptive(dates[:middle], sampling, logging)
+            yield from self._fetch_adaptive(dates[middle:], sampling, logging)
+            return
+        yield dates, result
+
+    def _get_report_ranges(self, body, sampling, analytics=None):
+        return self._report_ranges(body, sampling, analytics)[0]
+
+    def _report_ranges(self, body, sampling, analytics=None):
+        return _report_ranges(body, analytics or self.analytics, self.resource_quota, sampling, self.cache,
+                              self._page_workers, self._thread_analytics, self._keys(body, sampling))
+
+    def _keys(self, body, sampling):
+        # The request of the Body is hashed once by compile_template, only the date ranges differ per request.
+        return ReportCache.range_keys(self.body.request_hash, self.resource_quota, sampling,
+                                      body['reportRequests'][0]['dateRanges'])
+
+    def _thread_analytics(self):
+        # httplib2 is not thread-safe, so every worker thread gets its own service, unless the pooled transport is used.
+        return initialize_analyticsreporting(self.keyfile)
+
+    def _clean_result(self, result, clean_headers, clean_up=True):
+        if clean_headers:
+            result.columns = self.name_client.get_names(list(result.columns), return_type='name')
+        if self.clean_up_func and clean_up:
+            result = self.clean_up_func(result)
+        return result
+
+    def _transform(self, results: Iterator[pd.DataFrame], clean_headers: bool,
+                   processes: int) -> Iterator[pd.DataFrame]:
+        # The headers are renamed in this process. The clean_up function runs in a process pool, which works on a
+        # few results ahead while the fetching threads continue.
+        if not processes or not self.clean_up_func:
+            for result in results:
+                yield self._clean_result(result, clean_headers)
+            return
+
+        try:
+            pickle.dumps(self.clean_up_func)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            raise ValueError('The clean_up function cannot be sent to other processes. Define it at module level or '
+                             'use processes=0.') from None
+        renamed = (self._clean_result(result, clean_headers, clean_up=False) for result in results)
+        yield from _ordered_map(self.clean_up_func, renamed, processes, ProcessPoolExecutor)
 
     def to_csv(self, path):
         '''
@@ -102,12 +370,7 @@ class Query:
 
         >> Query.to_csv('C:/Users/someusr/Documents/example.csv')
         '''
-        if not os.path.isabs(path):
-            path = BASE_DIR + '\\' + path
-        df = pd.concat(self.results)
-        df.columns = self.name_client.get_names(list(df.columns.values), return_type='name')
-        df.to_csv(path, index=False)
-        print(f'CSV created: {path}')
+        self._export(CsvSink(path, columns=_result_columns(self.results)))
 
     def to_sqlite(self, headers: list = None, db_name: str = None, table_name='results', if_exists='append'):
         '''
@@ -121,122 +384,211 @@ class Query:
             Body object will be used. If that also isn't specified, it will fall back to Query [num], depending on the
             amount of Body instances. Ex. Query 0 for the first one.
         '''
-        if not os.path.exists(f'{BASE_DIR}\\Query results'):
-            os.mkdir(f'{BASE_DIR}\\Query results')
         if not db_name:
             db_name = self.body.name
+        self._export(SqliteSink(db_name, headers=headers, table_name=table_name, if_exists=if_exists,
+                                columns=_result_columns(self.results)))
 
-        df = pd.concat(self.results)
-        if headers:
-            cols = df.columns
-            if len(cols) == len(headers):
-                df.columns = headers
-            elif len(cols) < len(headers):
-                raise ValueError(f'Too many headers ({len(headers)}) specified for the amount of '
-                                 f'columns ({len(cols)}). Cannot write to SQLite.')
-            else:
-                raise ValueError(
-                    f'Too few headers ({len(headers)}) specified for the amount of columns ({len(cols)}).'
-                    f' Cannot write to SQLite.')
-        else:
-            df.columns = self.name_client.get_names(list(df.columns.values), return_type='name')
-
-        clean_cols = []
-        for col in df.columns:
-            if type(col) == str:
-                new_col = ''
-                for char in col:
-                    if char in string.punctuation or char == ' ':
-                        new_col += '_'
-                    else:
-                        new_col += char
-                clean_cols.append(new_col)
-            else:
-                clean_cols.append(col)
-
-        df.columns = clean_cols
-        with db.connect(f'{BASE_DIR}\\Query results\\' + db_name) as conn:
-            df.to_sql(table_name, conn, index=False, if_exists=if_exists)
-            print(f'Results saved to {BASE_DIR}\\Query results\\{db_name}.db, using \'{table_name}\' as '
-                  f'the table name and {", ".join(clean_cols)} as columns.')
+    def _export(self, sink):
+        try:
+            for result in self.results:
+                sink(result)
+        finally:
+            sink.close()
 
     def to_dataframe(self) -> pd.DataFrame:
         '''
         Return the query results as a pandas DataFrame for data manipulation and analysis.
         '''
-        df = pd.concat(self.results)
+        df = concat_results(self.results)
         df.columns = self.name_client.get_names(list(df.columns.values), return_type='name')
         return df
 
 
-@lru_cache
-def get_report(body: str, analytics: Any, resource_quota: bool, sampling: str) -> pd.DataFrame:
-    page_token = True
-    body = json.loads(body)
-    date = body['reportRequests'][0]['dateRanges'][0]['startDate']
-    results = []
-    while page_token:
-        response = analytics.reports().batchGet(body=body).execute()
-        for k, v in response.items():
-            for report in v:
-                dim_headers = report['columnHeader']['dimensions']
-                met_headers = [f['name'] for f in report['columnHeader']['metricHeader']['metricHeaderEntries']]
-                report_data = report['data']
-
-                try:
-                    rows = report_data['rows']
-                except KeyError:
-                    results.append(pd.DataFrame())
-                    continue
-                data = [row['dimensions'] + row['metrics'][0]['values'] for row in rows]
-                headers = dim_headers + met_headers
-                df_sub = pd.DataFrame(data=data, columns=headers)
-
-                if 'SamplingReadCounts' in report_data.keys():
-                    sample_size = int(body['samplesReadCounts'][0]) / int(body['samplingSpaceSizes'][0])
-                    if resource_quota and 'useResourceQuotas' not in list(body.keys()):
-                        body['useResourceQuotas'] = True
-                        return get_report(json.dumps(body), analytics, resource_quota, sampling)
-                    elif sampling == 'save':
-                        df_sub['Sampling'] = sample_size
-                        percentage = round(sample_size * 100, 1)
-                        print(f'{date} contains sampled data: {percentage}%')
-                    elif sampling == 'fail':
-                        if os.path.exists(DIR + '\\partial_results.db'):
-                            conn = db.connect(DIR + '\\partial_results.db')
-                            df = pd.read_sql('SELECT * FROM results', conn)
-                            df.to_csv(BASE_DIR + '\\partial_results.csv', index=False)
-                            conn.close()
-                            os.remove('partial_results.db')
-                            csv = True
-                        else:
-                            csv = False
-                        raise SamplingError(sample_size, csv)
-                    else:
-                        """skip"""
-                        results.append(pd.DataFrame())
-                        print(f'{date} contains sampled data and will not be available in the results')
-                        continue
+def _result_columns(results: List[pd.DataFrame]) -> list:
+    columns = []
+    for result in results:
+        columns += [col for col in result.columns if col not in columns]
+    return columns
+
+
+def get_report(body: Union[str, dict], analytics: Any, resource_quota: bool, sampling: str, cache: ReportCache = None,
+               page_workers: int = 1, analytics_factory: Callable = None) -> pd.DataFrame:
+    return concat_results(get_report_ranges(body, analytics, resource_quota, sampling, cache, page_workers,
+                                            analytics_factory))
+
+
+def get_report_ranges(body: Union[str, dict], analytics: Any, resource_quota: bool, sampling: str,
+                      cache: ReportCache = None, page_workers: int = 1, analytics_factory: Callable = None,
+                      keys: List[str] = None) -> List[pd.DataFrame]:
+    '''
+    Retrieve every page of a report request and return the rows as one DataFrame per date range in the request.
+    Rows which only have values for another date range are left out, so each DataFrame matches the result of a
+    request for that date range alone. Date ranges are looked up in the cache separately, so the request is
+    only sent when at least one of them has not been fetched before.
+
+    When the first page reports the total row count, the remaining pages are requested with page_workers threads
+    at once. Every thread uses its own service from analytics_factory, since the service is not thread-safe.
+
+    The body is changed while its pages are requested. keys are the cache keys of its date ranges, see
+    ReportCache.range_keys; they are created from the body when left out.
+    '''
+    return _report_ranges(body, analytics, resource_quota, sampling, cache, page_workers, analytics_factory, keys)[0]
+
+
+def _report_ranges(body: Union[str, dict], analytics: Any, resource_quota: bool, sampling: str, cache: ReportCache,
+                   page_workers: int, analytics_factory: Callable, keys: List[str]) -> Tuple[List[pd.DataFrame], bool]:
+    # Returns the results and whether they were all found in the cache.
+    if cache is None:
+        cache = DEFAULT_CACHE
+    if isinstance(body, str):
+        body = json.loads(body)
+    if keys is None:
+        keys = cache.keys(body, resource_quota, sampling)
+    cached = _cached_ranges(keys, body['reportRequests'][0]['dateRanges'], cache)
+    if cached is not None:
+        return cached, True
+
+    results = _fetch_report_ranges(body, analytics, resource_quota, sampling, page_workers, analytics_factory)
+    _cache_ranges(keys, results, cache)
+    return results, False
+
+
+def _cached_ranges(keys: List[str], date_ranges: list, cache: ReportCache) -> Optional[List[pd.DataFrame]]:
+    cached = []
+    for key, date_range in zip(keys, date_ranges):
+        df = cache.get(key, date_range)
+        if df is None:
+            return None
+        cached.append(df)
+    return cached
+
+
+def _cache_ranges(keys: List[str], results: List[pd.DataFrame], cache: ReportCache):
+    for key, df in zip(keys, results):
+        cache.put(key, df)
+
+
+def _fetch_report_ranges(body: dict, analytics: Any, resource_quota: bool, sampling: str, page_workers: int = 1,
+                         analytics_factory: Callable = None) -> List[pd.DataFrame]:
+    if len(body['reportRequests']) > 1:
+        return _fetch_split(body, analytics, resource_quota, sampling, analytics_factory)
+    request = body['reportRequests'][0]
+    if 'pageSize' not in request:
+        request['pageSize'] = MAX_PAGE_SIZE
+    reader = ReportReader(body, resource_quota, sampling)
+    pages = _iter_pages(body, analytics, page_workers, analytics_factory)
+    try:
+        for report in pages:
+            if not reader.add(report):
+                break
+    except ResourceQuotaRetry:
+        body['useResourceQuotas'] = True
+        request.pop('pageToken', None)
+        return _fetch_report_ranges(body, analytics, resource_quota, sampling, page_workers, analytics_factory)
+    finally:
+        pages.close()
+    return reader.results()
+
+
+def _fetch_split(body: dict, analytics: Any, resource_quota: bool, sampling: str,
+                 analytics_factory: Callable = None) -> List[pd.DataFrame]:
+    # The requests of a split Body are sent in parallel, every thread with its own service from analytics_factory.
+    def fetch(sub_body):
+        return _fetch_report_ranges(sub_body, analytics_factory() if analytics_factory else analytics, resource_quota,
+                                    sampling, 1, analytics_factory)
+
+    sub_bodies = split_body(body)
+    if analytics_factory:
+        results = list(_ordered_map(fetch, sub_bodies, len(sub_bodies)))
+    else:
+        results = [fetch(sub_body) for sub_body in sub_bodies]
+    return join_results(body['reportRequests'], results)
+
+
+def _iter_pages(body: dict, analytics: Any, page_workers: int, analytics_factory: Callable) -> Iterator[dict]:
+    report = analytics.reports().batchGet(body=body).execute(num_retries=RETRIES)['reports'][0]
+    yield report
+    token = report.get('nextPageToken')
+    row_count = report['data'].get('rowCount')
+    page_size = body['reportRequests'][0]['pageSize']
+
+    # Page tokens of the Reporting API are row offsets, so the remaining pages are known after the first one.
+    if token and token.isdigit() and row_count and page_workers > 1 and analytics_factory:
+        def fetch(offset):
+            return analytics_factory().reports().batchGet(body=page_body(body, offset)).execute(
+                num_retries=RETRIES)['reports'][0]
+
+        yield from _ordered_map(fetch, range(int(token), row_count, page_size), page_workers)
+        return
+
+    while token:
+        body['reportRequests'][0]['pageToken'] = token
+        report = analytics.reports().batchGet(body=body).execute(num_retries=RETRIES)['reports'][0]
+        yield report
+        token = report.get('nextPageToken')
+
+
+def page_body(body: dict, token) -> dict:
+    '''
+    Return a copy of a single request body for another page. Only the request itself is copied, the other parts are
+    shared with the original body.
+    '''
+    return dict(body, reportRequests=[dict(body['reportRequests'][0], pageToken=str(token))])
+
+
+def _ordered_map(func: Callable, items, workers: int,
+                 executor_class: Type[Executor] = ThreadPoolExecutor) -> Iterator:
+    '''
+    Apply func to items in a thread pool, or another pool given as executor_class, and yield the results in order.
+    Only a limited amount of items is submitted ahead of the consumer, so finished results cannot pile up in memory.
+    '''
+    executor = executor_class(max_workers=workers)
+    futures = deque()
+    try:
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= workers * 2:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _check_workers(workers):
+    if type(workers) != int or workers < 1:
+        warnings.warn('Invalid entry. The workers parameter must be a positive int. Value will be set to 1',
+                      UserWarning)
+        return 1
+    if workers > MAX_WORKERS:
+        warnings.warn(f'Google Analytics allows at most {MAX_WORKERS} concurrent requests per view. Value will be set '
+                      f'to {MAX_WORKERS}', UserWarning)
+        return MAX_WORKERS
+    return workers
+
+
+def _check_chunking(chunking: Optional[str], per_day: bool, adaptive: bool = False) -> Optional[str]:
+    # per_day and adaptive are shortcuts for chunking='day' and 'adaptive'. None requests the full range at once.
+    if chunking is None:
+        return 'adaptive' if adaptive else 'day' if per_day else None
+    if chunking not in list(CHUNKINGS) + ['adaptive']:
+        raise ValueError(f'{chunking} is not a valid chunking. Use one of: {", ".join(CHUNKINGS)}, adaptive.')
+    return chunking
+
 
-                results.append(df_sub)
+def _logged(fetched: Iterator, logging: bool) -> Iterator[pd.DataFrame]:
+    for chunk, result in fetched:
+        if logging:
+            print(f'Result for {_describe(chunk)} contains {len(result)} rows')
+        yield result
 
-                if 'nextPageToken' in report.keys():
-                    body['reportRequests'][0]['pageToken'] = report['nextPageToken']
-                    continue
-                else:
-                    page_token = False
 
-    return pd.concat(results)
+def _describe(chunk: List[str]) -> str:
+    if len(chunk) == 1:
+        return f'date {chunk[0]}'
+    return f'dates {chunk[0]} to {chunk[-1]}'
 
 
 def calc_range(start, end) -> List[str]:
-    if type(start) == str and type(end) == str:
-        start = datetime.strptime(start, '%Y-%m-%d')
-        end = datetime.strptime(end, '%Y-%m-%d')
-
-    if start == end:
-        return [datetime.strftime(start, '%Y-%m-%d')]
-    delta = end - start
-    if delta.days < 0:
-        delta = start - end
-    return [datetime.strftime(end - timedelta(days=day), '%Y-%m-%d') for day in range(delta.days + 1)][::-1]
+    return DateRange(start, end).days()
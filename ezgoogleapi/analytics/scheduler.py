@@ -0,0 +1,315 @@
+import copy
+import json
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import Callable, List
+from zoneinfo import ZoneInfo
+
+from ezgoogleapi.analytics.body import MAX_METRICS, compile_template
+from ezgoogleapi.analytics.cache import ReportCache
+from ezgoogleapi.analytics.daterange import chunk_days
+from ezgoogleapi.analytics.query import Query, MAX_WORKERS, initialize_analyticsreporting, get_report_ranges, \
+    _check_chunking, _describe
+
+DEFAULT_QUOTA = {
+    'per_day': 50000,
+    'per_view_per_day': 10000,
+    'per_100_seconds': 100,
+    'concurrent_per_view': 10
+}
+RETRIES = 5
+# The daily quota of the Reporting API resets at midnight Pacific Time.
+QUOTA_TIMEZONE = 'America/Los_Angeles'
+
+
+class TokenBucket:
+    def __init__(self, capacity: int, period: float):
+        '''
+        Thread-safe token bucket which hands out at most capacity tokens per period, refilled evenly over time.
+
+        :param capacity: Maximum amount of tokens, which is also the amount of tokens available at the start.
+        :param period: Amount of seconds in which the bucket fully refills.
+        '''
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.waited = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+                self.waited += wait
+            time.sleep(wait)
+
+
+class DailyQuota:
+    def __init__(self, limit: int, timezone: str = QUOTA_TIMEZONE):
+        '''
+        Thread-safe counter which hands out at most limit tokens per day. The count resets at midnight in the given
+        timezone, like the daily quota of the Reporting API, so requests which are over the limit wait until then.
+
+        :param limit: Maximum amount of tokens per day.
+        :param timezone: [optional] Timezone of the daily reset. Default: 'America/Los_Angeles'.
+        '''
+        self.limit = limit
+        self.used = 0
+        self.waited = 0.0
+        self._timezone = ZoneInfo(timezone)
+        self._day = datetime.now(self._timezone).date()
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self) -> int:
+        with self._lock:
+            self._reset()
+            return self.limit - self.used
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._reset()
+                if self.used < self.limit:
+                    self.used += 1
+                    return
+                tomorrow = self._day + timedelta(days=1)
+                midnight = datetime(tomorrow.year, tomorrow.month, tomorrow.day, tzinfo=self._timezone)
+                wait = max(midnight.timestamp() - time.time(), 1)
+                self.waited += wait
+            time.sleep(wait)
+
+    def _reset(self):
+        today = datetime.now(self._timezone).date()
+        if today != self._day:
+            self._day = today
+            self.used = 0
+
+
+class QueryScheduler:
+    def __init__(self, bodies: list, keyfile: str, clean_up: Callable = None, cache: ReportCache = None,
+                 priorities: List[int] = None, workers: int = MAX_WORKERS, quota: dict = None, coalesce: bool = True):
+        '''
+        Run many Body objects, possibly for different views, under the quota of the Reporting API. The work is
+        split into (view, date) units which are executed by a shared pool of workers. Every request counts against
+        the daily project quota and the daily quota of its view, which reset at midnight Pacific Time, and takes a
+        token from the quota per 100 seconds. At most 'concurrent_per_view' requests run at the same time for a view.
+
+        :param bodies: List of ezgoogleapi.analytics.Body objects.
+        :param keyfile: JSON keyfile name in the form "file_name.json".
+        :param clean_up: [optional] Clean-up function applied to every result, like for Query.
+        :param cache: [optional] ReportCache object shared by all queries.
+        :param priorities: [optional] Priority per body, lower values are executed first. Default: 0 for all.
+        :param workers: [optional] Amount of requests in flight over all views. Default: 10.
+        :param quota: [optional] Dictionary to override the quota limits 'per_day', 'per_view_per_day',
+            'per_100_seconds' and 'concurrent_per_view'.
+        :param coalesce: [optional] Default True. Bodies which only differ in their metrics share a single request
+            with the metrics of all of them, up to 10 metrics. The results are split back per body.
+        '''
+        self.keyfile = keyfile
+        self.queries = [Query(body, keyfile, clean_up, cache) for body in bodies]
+        self.priorities = priorities if priorities is not None else [0 for _ in bodies]
+        if len(self.priorities) != len(bodies):
+            raise ValueError(f'{len(self.priorities)} priorities given for {len(bodies)} bodies.')
+        self.runs = self._coalesce(cache) if coalesce else [(query, [i]) for i, query in enumerate(self.queries)]
+        self.workers = workers
+        self.quota = {**DEFAULT_QUOTA, **(quota or {})}
+        self.errors = []
+        self.usage = {'requests': 0, 'views': {}}
+        self._project_quota = DailyQuota(self.quota['per_day'])
+        self._window_bucket = TokenBucket(self.quota['per_100_seconds'], 100)
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def plan(self, per_day: bool = True, pack_days: bool = False, chunking: str = None) -> list:
+        '''
+        Return the work units as (priority, order, run index, chunks, request body) tuples, in the order they will
+        be submitted. A run is a query from QueryScheduler.runs, which may hold the metrics of several bodies. Units
+        of equal priority are interleaved over the runs, so the views are spread over time.
+        '''
+        chunking = _check_chunking(chunking, per_day)
+        if chunking == 'adaptive':
+            raise ValueError('QueryScheduler does not support the \'adaptive\' chunking, since the amount of requests '
+                             'has to be known in advance. Use \'day\', \'week\' or \'month\'.')
+        units = []
+        for i, (query, targets) in enumerate(self.runs):
+            priority = min(self.priorities[target] for target in targets)
+            dates = query.date_range
+            if chunking:
+                requests = query._chunks(chunk_days(dates, chunking), pack_days)
+            else:
+                requests = [([dates], query.body.request([{'startDate': dates[0], 'endDate': dates[-1]}]))]
+            for order, (chunks, body) in enumerate(requests):
+                units.append((priority, order, i, chunks, body))
+        units.sort(key=lambda unit: unit[:3])
+
+        if len(units) > self.quota['per_day']:
+            warnings.warn(f'{len(units)} work units are planned, which is more than the daily quota of '
+                          f'{self.quota["per_day"]} requests. The scheduler will wait for the quota to refill.',
+                          UserWarning)
+        return units
+
+    def run(self, per_day: bool = True, sampling: str = 'fail', clean_headers: bool = False, logging: bool = True,
+            pack_days: bool = False, chunking: str = None):
+        '''
+        Execute all work units and save the results to the results of each query in QueryScheduler.queries, in
+        date order. Units which fail are reported in QueryScheduler.errors without stopping the others. Takes the
+        same parameters as Query.run(), except for the 'adaptive' chunking.
+        '''
+        units = self.plan(per_day, pack_days, chunking)
+        results = [{} for _ in self.queries]
+
+        def execute(unit):
+            _, _, i, _, body = unit
+            query = self.runs[i][0]
+            return get_report_ranges(body, self._analytics(query.body.view_id), query.resource_quota, sampling,
+                                     query.cache, keys=query._keys(body, sampling))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(execute, unit): unit for unit in units}
+            for future in as_completed(futures):
+                _, _, i, chunks, _ = futures[future]
+                run, targets = self.runs[i]
+                try:
+                    frames = future.result()
+                except Exception as err:
+                    for target in targets:
+                        self.errors.append((self.queries[target].body.name, [chunk[0] for chunk in chunks], err))
+                    if logging:
+                        print(f'{run.body.name} failed for {_describe(chunks[0])}: {err}')
+                    continue
+                for chunk, frame in zip(chunks, frames):
+                    date = chunk[0]
+                    if logging:
+                        print(f'{run.body.name}: result for {_describe(chunk)} contains {len(frame)} rows')
+                    for target in targets:
+                        query = self.queries[target]
+                        result = frame
+                        if len(targets) > 1:
+                            result = _split_result(frame, query.body.metrics, run.body.metrics)
+                        results[target][date] = query._clean_result(result, clean_headers)
+
+        for query, result in zip(self.queries, results):
+            query.results += [result[date] for date in sorted(result)]
+        if logging:
+            print(self.quota_report())
+
+    def quota_report(self) -> dict:
+        '''
+        Return the amount of requests sent in total and per view, the seconds spent waiting for quota (summed over
+        the workers) and the remaining daily project quota until midnight Pacific Time. Requests sent by other
+        processes are not known to the scheduler.
+        '''
+        with self._lock:
+            return {
+                'requests': self.usage['requests'],
+                'requests_per_view': dict(self.usage['views']),
+                'throttled_seconds': round(self._window_bucket.waited + self._project_quota.waited +
+                                           sum(quota.waited for quota, _ in self._views.values()), 1),
+                'remaining_per_day': self._project_quota.remaining
+            }
+
+    def _coalesce(self, cache):
+        # Bodies which only differ in their metrics are packed greedily into as few requests as possible.
+        groups = {}
+        for i, query in enumerate(self.queries):
+            requests = query.body.body['reportRequests']
+            if len(requests) > 1:
+                key = i
+            else:
+                request = {field: value for field, value in requests[0].items() if field != 'metrics'}
+                key = json.dumps([request, query.date_range, query.resource_quota], sort_keys=True)
+            groups.setdefault(key, []).append(i)
+
+        runs = []
+        for group in groups.values():
+            bins = []
+            for i in group:
+                for metrics, targets in bins:
+                    union = metrics + [met for met in self.queries[i].body.metrics if met not in metrics]
+                    if len(union) <= MAX_METRICS:
+                        metrics[:] = union
+                        targets.append(i)
+                        break
+                else:
+                    bins.append((list(self.queries[i].body.metrics), [i]))
+
+            for metrics, targets in bins:
+                if len(targets) == 1:
+                    runs.append((self.queries[targets[0]], targets))
+                    continue
+                body = copy.copy(self.queries[targets[0]].body)
+                body.metrics = metrics
+                body.name = ' + '.join(self.queries[target].body.name for target in targets)
+                body.body = json.loads(json.dumps(body.body))
+                body.body['reportRequests'][0]['metrics'] = [{'expression': met} for met in metrics]
+                compile_template(body)
+                runs.append((Query(body, self.keyfile, cache=cache), targets))
+        return runs
+
+    def _analytics(self, view_id):
+        return _MeteredAnalytics(initialize_analyticsreporting(self.keyfile), lambda: self._acquire(view_id),
+                                 self._view(view_id)[1])
+
+    def _view(self, view_id):
+        with self._lock:
+            if view_id not in self._views:
+                self._views[view_id] = (DailyQuota(self.quota['per_view_per_day']),
+                                        threading.Semaphore(self.quota['concurrent_per_view']))
+            return self._views[view_id]
+
+    def _acquire(self, view_id):
+        self._view(view_id)[0].acquire()
+        self._project_quota.acquire()
+        self._window_bucket.acquire()
+        with self._lock:
+            self.usage['requests'] += 1
+            self.usage['views'][view_id] = self.usage['views'].get(view_id, 0) + 1
+
+
+def _split_result(result, metrics: list, all_metrics: list):
+    # Rows where all metrics of a body are 0 would not have been in its own result, so they are left out. The
+    # columns are put in the order of the body, as if it had been requested on its own.
+    metrics = [met for met in metrics if met in result.columns]
+    dimensions = [col for col in result.columns if col not in all_metrics and col != 'Sampling']
+    result = result[dimensions + metrics + (['Sampling'] if 'Sampling' in result.columns else [])]
+    if metrics:
+        result = result[(result[metrics] != 0).any(axis=1)]
+    return result
+
+
+class _MeteredAnalytics:
+    # Stands in for the analytics service, so every batchGet call is counted against the quota.
+    def __init__(self, analytics, acquire, semaphore):
+        self._analytics = analytics
+        self._acquire = acquire
+        self._semaphore = semaphore
+
+    def reports(self):
+        return self
+
+    def batchGet(self, body):
+        return _MeteredRequest(self._analytics.reports().batchGet(body=body), self._acquire, self._semaphore)
+
+
+class _MeteredRequest:
+    def __init__(self, request, acquire, semaphore):
+        self._request = request
+        self._acquire = acquire
+        self._semaphore = semaphore
+
+    def execute(self, **kwargs):
+        self._acquire()
+        with self._semaphore:
+            kwargs['num_retries'] = max(kwargs.get('num_retries', 0), RETRIES)
+            return self._request.execute(**kwargs)
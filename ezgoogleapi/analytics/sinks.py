@@ -0,0 +1,245 @@
+import os
+import queue
+import sqlite3 as db
+import string
+import threading
+import warnings
+from datetime import datetime
+from typing import Any, Callable, List, Optional
+
+import pandas as pd
+
+from ezgoogleapi.analytics.variable_names import VariableName
+
+BASE_DIR = os.getcwd()
+# Formats of the date column in tables written by Query.to_sqlite(), now and by earlier versions.
+DATE_FORMATS = ['%Y%m%d', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S']
+
+
+class _Sink:
+    def __init__(self, columns: list = None):
+        self.columns = columns
+        self.rows = 0
+        self._warned = False
+
+    def __call__(self, df: pd.DataFrame):
+        if df.empty:
+            return
+        if self.columns is None:
+            self.columns = list(df.columns)
+        else:
+            extra = [col for col in df.columns if col not in self.columns]
+            if extra and not self._warned:
+                warnings.warn(f'Columns {", ".join(map(str, extra))} were not in the first result and will not be '
+                              f'written.', UserWarning)
+                self._warned = True
+            df = df.reindex(columns=self.columns)
+        self.write(df)
+        self.rows += len(df)
+
+    def write(self, df: pd.DataFrame):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CsvSink(_Sink):
+    def __init__(self, path: str, columns: list = None):
+        '''
+        Write results to a CSV file one DataFrame at a time. Headers containing Google Analytics API codes will be
+        replaced by their regular variable name.
+
+        :param path: Relative or absolute path to the yet-to-be created CSV file.
+        :param columns: [optional] Columns to write. Defaults to the columns of the first DataFrame.
+        '''
+        super().__init__(columns)
+        if not os.path.isabs(path):
+            path = BASE_DIR + '\\' + path
+        self.path = path
+        self.name_client = VariableName()
+        self._header = True
+
+    def write(self, df: pd.DataFrame):
+        df = df.copy(deep=False)
+        df.columns = self.name_client.get_names(list(df.columns.values), return_type='name')
+        df.to_csv(self.path, index=False, header=self._header, mode='w' if self._header else 'a')
+        self._header = False
+
+    def close(self):
+        if self._header:
+            pd.DataFrame(columns=self.columns or []).to_csv(self.path, index=False)
+        print(f'CSV created: {self.path}')
+
+
+class SqliteSink(_Sink):
+    def __init__(self, db_name: str, headers: list = None, table_name: str = 'results', if_exists: str = 'append',
+                 columns: list = None):
+        '''
+        Write results to a SQLite database one DataFrame at a time. Headers containing Google Analytics API codes
+        will be replaced by their regular variable name. Any special characters or spaces will be replaced by an
+        underscore.
+
+        :param db_name: Name of the database in the 'Query results' folder.
+        :param headers: [optional] Specify custom headers for the columns.
+        :param table_name: [optional] Defaults to 'results'
+        :param if_exists: [optional] Defaults to 'append'. Only applies to the first write.
+        :param columns: [optional] Columns to write. Defaults to the columns of the first DataFrame.
+        '''
+        super().__init__(columns)
+        if not os.path.exists(f'{BASE_DIR}\\Query results'):
+            os.mkdir(f'{BASE_DIR}\\Query results')
+        self.db_name = db_name
+        self.headers = headers
+        self.table_name = table_name
+        self.if_exists = if_exists
+        self.name_client = VariableName()
+        self.clean_cols = None
+        # The connection may be used by the writing thread of Query.stream(), one thread at a time.
+        self.conn = db.connect(f'{BASE_DIR}\\Query results\\' + db_name, check_same_thread=False)
+
+    def write(self, df: pd.DataFrame):
+        if self.clean_cols is None:
+            self.clean_cols = _clean_columns(self._headers(list(df.columns)))
+        df = df.copy(deep=False)
+        df.columns = self.clean_cols
+        df.to_sql(self.table_name, self.conn, index=False, if_exists=self.if_exists)
+        self.conn.commit()
+        self.if_exists = 'append'
+
+    def watermark(self, column: str) -> Optional[pd.Timestamp]:
+        '''
+        Return the latest value of a date column in the table, or None when the table does not exist or is empty.
+        '''
+        try:
+            value = self.conn.execute(f'SELECT MAX({_date_sql(column)}) FROM "{self.table_name}"').fetchone()[0]
+        except db.OperationalError:
+            return None
+        return pd.Timestamp(value) if value is not None else None
+
+    def replace_from(self, column: str, start: str, results: List[pd.DataFrame]):
+        '''
+        Delete the rows from the given date onwards and write the new results in their place, in one transaction.
+        The results need the column names of the table. Dates are compared whether the table holds them as YYYYMMDD,
+        like older versions wrote ga:date, or as YYYY-MM-DD, and new dates are written in the format of the table.
+        '''
+        results = [result for result in results if not result.empty]
+        df = pd.concat(results) if results else None
+        existing = None
+        if self.conn.execute('SELECT 1 FROM sqlite_master WHERE type = \'table\' AND name = ?',
+                             (self.table_name,)).fetchone():
+            existing = self.conn.execute(f'SELECT "{column}" FROM "{self.table_name}" WHERE "{column}" IS NOT NULL '
+                                         f'LIMIT 1').fetchone()
+            self.conn.execute(f'DELETE FROM "{self.table_name}" WHERE {_date_sql(column)} >= ?', (start,))
+        date_format = _date_format(existing[0]) if existing else None
+        if df is not None and date_format and column in df.columns:
+            df[column] = pd.to_datetime(df[column]).dt.strftime(date_format)
+
+        # pandas commits after writing the rows and rolls back on an error, which includes the DELETE.
+        try:
+            if df is not None:
+                df.to_sql(self.table_name, self.conn, index=False, if_exists='append')
+                self.clean_cols = list(df.columns)
+                self.rows += len(df)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def close(self):
+        self.conn.close()
+        if self.clean_cols is not None:
+            print(f'Results saved to {BASE_DIR}\\Query results\\{self.db_name}.db, using \'{self.table_name}\' as '
+                  f'the table name and {", ".join(self.clean_cols)} as columns.')
+
+    def _headers(self, cols: list) -> list:
+        if not self.headers:
+            return self.name_client.get_names(cols, return_type='name')
+        if len(cols) == len(self.headers):
+            return self.headers
+        elif len(cols) < len(self.headers):
+            raise ValueError(f'Too many headers ({len(self.headers)}) specified for the amount of '
+                             f'columns ({len(cols)}). Cannot write to SQLite.')
+        else:
+            raise ValueError(
+                f'Too few headers ({len(self.headers)}) specified for the amount of columns ({len(cols)}).'
+                f' Cannot write to SQLite.')
+
+
+class _BackgroundSink:
+    _done = object()
+
+    def __init__(self, sink: Callable[[pd.DataFrame], Any], queue_size: int):
+        '''
+        Pass results to a sink from a separate thread. Results wait in a bounded queue, so a sink that falls behind
+        blocks the caller instead of letting the results pile up in memory. An error of the sink is raised on the
+        next call or on close().
+        '''
+        self.sink = sink
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __call__(self, df: pd.DataFrame):
+        self._raise()
+        self._queue.put(df)
+
+    def close(self):
+        self._queue.put(self._done)
+        self._thread.join()
+        self._raise()
+
+    def _run(self):
+        while True:
+            df = self._queue.get()
+            if df is self._done:
+                break
+            # After an error the queue is still emptied, so the caller never blocks on a full queue.
+            if self._error is None:
+                try:
+                    self.sink(df)
+                except Exception as err:
+                    self._error = err
+        if hasattr(self.sink, 'close'):
+            try:
+                self.sink.close()
+            except Exception as err:
+                self._error = self._error or err
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+def _date_sql(column: str) -> str:
+    # The date of a column holding YYYYMMDD, YYYY-MM-DD or YYYY-MM-DD HH:MM:SS, as YYYY-MM-DD.
+    return f'(CASE WHEN length("{column}") = 8 THEN substr("{column}", 1, 4) || \'-\' || substr("{column}", 5, 2) ' \
+           f'|| \'-\' || substr("{column}", 7, 2) ELSE substr("{column}", 1, 10) END)'
+
+
+def _date_format(value) -> Optional[str]:
+    for date_format in DATE_FORMATS:
+        try:
+            datetime.strptime(str(value), date_format)
+            return date_format
+        except ValueError:
+            pass
+    return None
+
+
+def _clean_columns(columns: list) -> List[str]:
+    clean_cols = []
+    for col in columns:
+        if type(col) == str:
+            new_col = ''
+            for char in col:
+                if char in string.punctuation or char == ' ':
+                    new_col += '_'
+                else:
+                    new_col += char
+            clean_cols.append(new_col)
+        else:
+            clean_cols.append(col)
+    return clean_cols
@@ -1,3 +1,4 @@
+import gzip
 import os
 import pathlib
 import re
@@ -5,33 +6,69 @@ from typing import Union, List
 import json
 from urllib import request
 import sqlite3 as db
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+import threading
 import pandas as pd
-from ezgoogleapi.bigquery.base import check_keyfile
+from ezgoogleapi.common.connections import get_service
+from ezgoogleapi.common.validation import check_keyfile
 
 DIR = str(pathlib.Path(__file__).parent)
 BASE_DIR = os.getcwd()
+CATALOG = os.path.join(DIR, 'data', 'ga_vars.json.gz')
+CATALOG_URL = 'https://rrwielema.github.io/page/apis/ga_vars.json'
 
 
-class VariableName:
+class _Catalog:
     def __init__(self):
         '''
-        Class to instantiate a search object for variable names
+        All variable names from the database, with case-insensitive indexes by name and by API code.
         '''
         db_loc = f'{DIR}\\google_api_variable_names.db'
         if not os.path.exists(db_loc):
             NameDatabase.create_database()
         conn = db.connect(db_loc)
         self.all_names = pd.read_sql('SELECT * FROM vars', con=conn)
-
         conn.close()
 
-        if len(self.all_names[self.all_names['type'] == 'Custom Dimension']) == 0 and \
-                len(self.all_names[self.all_names['type'] == 'Custom Metric']) == 0:
-            self.cd_cm = False
-        else:
-            self.cd_cm = True
+        self.by_name = {}
+        self.by_apicode = {}
+        for record in self.all_names.to_dict('records'):
+            self.by_name.setdefault(record['name'].lower(), record)
+            self.by_apicode.setdefault(record['apicode'].lower(), record)
+        self.cd_cm = any(record['type'] in ('Custom Dimension', 'Custom Metric') for record in self.by_apicode.values())
+
+
+_catalog = None
+_catalog_lock = threading.RLock()
+
+
+def _get_catalog() -> _Catalog:
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = _Catalog()
+        return _catalog
+
+
+def _invalidate_catalog():
+    global _catalog
+    with _catalog_lock:
+        _catalog = None
+
+
+class VariableName:
+    def __init__(self):
+        '''
+        Class to instantiate a search object for variable names. The names are loaded from the database once per
+        process and shared by all instances.
+        '''
+
+    @property
+    def all_names(self) -> pd.DataFrame:
+        return _get_catalog().all_names
+
+    @property
+    def cd_cm(self) -> bool:
+        return _get_catalog().cd_cm
 
     def get_names(self, names: Union[list, str], return_type: str = None) -> Union[List[dict], list]:
         '''
@@ -47,53 +84,74 @@ class VariableName:
         if type(names) == str:
             names = [names]
 
+        catalog = _get_catalog()
         results = []
         for name in names:
             if 'ga:' in name:
                 if name == 'ga:segment' or name == 'Segment':
                     results.append({'name': 'Segment', 'type': 'dimension', 'apicode': name})
                     continue
-                if 'ga:metric' in name and not self.cd_cm:
+                if 'ga:metric' in name and not catalog.cd_cm:
                     num = name.replace('ga:metric', '')
                     results.append({'name': f'Metric {num}', 'type': 'metric', 'apicode': name})
                     continue
 
-                if 'ga:dimension' in name and not self.cd_cm:
+                if 'ga:dimension' in name and not catalog.cd_cm:
                     num = name.replace('ga:dimension', '')
                     results.append({'name': f'Dimension {num}', 'type': 'dimension', 'apicode': name})
                     continue
 
-                df_name = self.all_names[self.all_names['apicode'].apply(lambda x: x.lower()) == name.lower()]
-                if len(df_name) == 0:
+                record = catalog.by_apicode.get(name.lower())
+                if record is None:
                     raise ValueError(f'\'{name}\' is not a valid API code.')
             else:
-                df_name = self.all_names[self.all_names['name'].apply(lambda x: x.lower()) == name.lower()]
-                if len(df_name) == 0:
+                record = catalog.by_name.get(name.lower())
+                if record is None:
                     raise ValueError(f'\'{name}\' is not a valid variable name.')
 
-            results.append(df_name.to_dict('records')[0])
+            results.append(dict(record))
 
         if return_type == 'name':
             return [f['name'] for f in results]
         elif return_type == 'apicode':
             return [f['apicode'] for f in results]
         return results
-    
+
 
 class NameDatabase:      
     @staticmethod
     def create_database():
         '''
         Creates an SQLite database with the standard Google Analytics dimensions and metrics.
-        Will be called automatically by VariableName if no DB is created yet.
+        Will be called automatically by VariableName if no DB is created yet. The names are read from the catalog
+        shipped with the package, and only downloaded when it is missing.
         '''
-        r = request.urlopen('https://rrwielema.github.io/page/apis/ga_vars.json')
-        ga_vars = json.loads(r.read())['data']
+        if os.path.exists(CATALOG):
+            with gzip.open(CATALOG, 'rt', encoding='utf-8') as f:
+                ga_vars = json.load(f)['data']
+        else:
+            r = request.urlopen(CATALOG_URL)
+            ga_vars = json.loads(r.read())['data']
         df = pd.DataFrame(ga_vars)
         conn = db.connect(f'{DIR}\\google_api_variable_names.db')
 
         df.to_sql('vars', conn, index=False, if_exists='replace')
         conn.close()
+        _invalidate_catalog()
+
+    @staticmethod
+    def update_catalog(path: str = CATALOG):
+        '''
+        Download the standard Google Analytics dimensions and metrics and save them as the gzipped JSON catalog
+        which is shipped with the package.
+
+        :param path: [optional] Path of the catalog. Default: data/ga_vars.json.gz in the package.
+        '''
+        r = request.urlopen(CATALOG_URL)
+        ga_vars = json.loads(r.read())['data']
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump({'data': ga_vars}, f, separators=(',', ':'))
 
     @staticmethod
     def add_custom_variables(keyfile: str, property_id: str, overwrite: bool = False):
@@ -130,8 +188,7 @@ class NameDatabase:
             raise ValueError(f'{property_id} is not a valid property ID in format UA-XXXXXXXX-X(X)')
 
         scopes = ['https://www.googleapis.com/auth/analytics.readonly']
-        credentials = Credentials.from_service_account_file(BASE_DIR + '\\' + keyfile, scopes=scopes)
-        analytics = build('analytics', 'v3', credentials=credentials)
+        analytics = get_service('analytics', 'v3', BASE_DIR + '\\' + keyfile, scopes)
 
         dimensions = analytics.management().customDimensions().list(
             accountId=property_id.split('-')[1],
@@ -159,3 +216,4 @@ class NameDatabase:
         conn = db.connect(f'{DIR}\\google_api_variable_names.db')
         df.to_sql('vars', conn, index=False, if_exists='append')
         conn.close()
+        _invalidate_catalog()
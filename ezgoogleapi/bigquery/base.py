@@ -1,13 +1,58 @@
+import io
+import json
 import math
+import random
+import time
+import uuid
 import warnings
-from typing import Union
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, datetime
+from typing import Callable, Iterator, Union, List
+import numpy as np
 import pandas as pd
+import requests
+from google.api_core.exceptions import NotFound, ServerError, TooManyRequests
 from google.cloud import bigquery
 import os
+from ezgoogleapi.common.connections import get_client, get_credentials
 from ezgoogleapi.common.validation import check_keyfile
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+
 
 BASE_DIR = os.getcwd()
+SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+# From this amount of rows insert_rows() uses load jobs instead of the streaming API.
+LOAD_THRESHOLD = 100000
+LOAD_FORMATS = {
+    'parquet': bigquery.SourceFormat.PARQUET,
+    'json': bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+}
+PARTITION_TYPES = ['DAY', 'HOUR', 'MONTH', 'YEAR']
+PARTITION_COLUMN_TYPES = ['DATE', 'DATETIME', 'TIMESTAMP']
+MAX_CLUSTERING_FIELDS = 4
+# strftime format of the partition decorator per partition type, as in Project.Dataset.Table$20210131.
+PARTITION_DECORATORS = {
+    'DAY': '%Y%m%d',
+    'HOUR': '%Y%m%d%H',
+    'MONTH': '%Y%m',
+    'YEAR': '%Y'
+}
+# The streaming API rejects requests over 10 MB, some room is left for the rest of the request.
+MAX_REQUEST_BYTES = 9 * 1024 ** 2
+RETRIES = 5
+BACKOFF = 1
+# Row errors which may succeed when the row is sent again. 'stopped' rows were only rejected because another row in
+# the same request was invalid.
+RETRY_REASONS = ['backendError', 'internalError', 'rateLimitExceeded', 'stopped', 'timeout']
 
 
 class BigQuery:
@@ -15,8 +60,9 @@ class BigQuery:
         if not os.path.isabs(keyfile):
             keyfile = BASE_DIR + '\\' + keyfile
         self.keyfile = check_keyfile(keyfile)
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = keyfile
-        self.client = bigquery.Client()
+        credentials = get_credentials(keyfile, SCOPES)
+        self.client = get_client('bigquery', keyfile,
+                                 lambda: bigquery.Client(credentials=credentials, project=credentials.project_id))
         self.table = None
         self.table_name = None
 
@@ -28,15 +74,48 @@ class BigQuery:
             self.table = table
             self.table_name = table.split('.')[2]
 
-    def create_table(self, schema: list):
+    def create_table(self, schema: list, partition_by: str = None, partition_type: str = 'DAY',
+                     cluster_by: List[str] = None, require_partition_filter: bool = False):
+        '''
+        Create the table. A partitioned table only scans the partitions a query filters on, and a clustered table
+        only the blocks that hold the filtered values, which lowers the bytes billed per query.
+
+        :param schema: List of column names, which become STRING columns, or lists of a column name and data type.
+        :param partition_by: [optional] DATE, DATETIME or TIMESTAMP column to partition the table on, e.g. the
+            column holding ga:date.
+        :param partition_type: [optional] 'DAY' (default), 'HOUR', 'MONTH' or 'YEAR'.
+        :param cluster_by: [optional] Up to 4 columns to cluster the table on, e.g. the dimensions that dashboards
+            filter on.
+        :param require_partition_filter: [optional] Reject queries which do not filter on the partition column.
+            Default: False.
+        '''
         sch = []
         for field in schema:
             if type(field) == list:
                 sch.append(bigquery.SchemaField(field[0], field[1]))
             else:
                 sch.append(bigquery.SchemaField(field, "STRING"))
+        types = {field.name: field.field_type.upper() for field in sch}
 
         new_table = bigquery.Table(self.table, schema=sch)
+        if partition_by:
+            if types.get(partition_by) not in PARTITION_COLUMN_TYPES:
+                raise ValueError(f'{partition_by} is not a DATE, DATETIME or TIMESTAMP column in the schema. Only '
+                                 f'those columns can be used to partition a table.')
+            if partition_type not in PARTITION_TYPES:
+                raise ValueError(f'{partition_type} is not a valid partition type. Use one of: '
+                                 f'{", ".join(PARTITION_TYPES)}.')
+            new_table.time_partitioning = bigquery.TimePartitioning(type_=partition_type, field=partition_by)
+            new_table.require_partition_filter = require_partition_filter
+        if cluster_by:
+            missing = [column for column in cluster_by if column not in types]
+            if missing:
+                raise ValueError(f'Columns {", ".join(missing)} are not in the schema and cannot be used to cluster '
+                                 f'the table.')
+            if len(cluster_by) > MAX_CLUSTERING_FIELDS:
+                raise ValueError(f'{len(cluster_by)} clustering columns were given, but BigQuery allows at most '
+                                 f'{MAX_CLUSTERING_FIELDS}.')
+            new_table.clustering_fields = cluster_by
         self.client.create_table(new_table)
         print(f'Created table {self.table_name}')
 
@@ -62,48 +141,306 @@ class BigQuery:
             query += ' WHERE ' + condition
 
         query_job = self.client.query(query)
-        if not query_job:
-            print('Rows deleted')
+        query_job.result()
+        print('Rows deleted')
 
-    def insert_rows(self, data: Union[list, dict, pd.DataFrame], per_request: int = 10000):
-        if per_request > 10000 or per_request < 0 or type(per_request) != int:
-            warnings.warn('Invalid entry. The per_request parameter is between 0 and 10000. Value will be set to 10000',
+    def insert_rows(self, data: Union[list, dict, pd.DataFrame], per_request: int = 10000, mode: str = 'auto',
+                    file_format: str = None, max_bytes: int = 256 * 1024 ** 2, workers: int = 4) -> List[dict]:
+        '''
+        Append rows to the table, either with the streaming API or with load jobs. Load jobs are free and much faster
+        for large amounts of rows, but BigQuery allows 1500 of them per table per day. Values are converted to the
+        type of their column in the table, so text like '1', 'true' or '2021-01-01 10:00:00' can be inserted into
+        INT64, BOOL and TIMESTAMP columns. Datetime columns, like ga:date, are converted to dates for DATE columns
+        and to text for STRING columns.
+
+        Streaming requests are sent by several threads at once and hold at most 10 MB. Requests that fail with a
+        server error are retried with exponential backoff. When BigQuery rejects some rows of a request, only those
+        rows are sent again, unless they are invalid. Every row has a fixed insert ID, so a retry does not add
+        duplicates. When a request still fails after the retries, its rows are returned as failed and the other
+        requests continue.
+
+        :param data: pandas DataFrame, list of dictionaries with the same keys, or list of lists where the first list
+            holds the headers.
+        :param per_request: [optional] Amount of rows per streaming request, at most 10000. Default: 10000.
+        :param mode: [optional] 'stream', 'load' or 'auto' (default). 'auto' streams fewer than 100.000 rows and uses
+            load jobs for more.
+        :param file_format: [optional] 'parquet' or 'json', the format the rows are sent in by load jobs. Default:
+            'parquet' when pyarrow is installed, otherwise 'json'.
+        :param max_bytes: [optional] Approximate size of the rows in memory that go into one load job. Default: 256 MB.
+        :param workers: [optional] Amount of streaming requests sent at the same time. Default: 4.
+        :return: List of the rows which could not be streamed, as dictionaries with the 'row' and its 'errors'.
+        '''
+        if mode not in ('auto', 'stream', 'load'):
+            raise ValueError(f'{mode} is not a valid mode. Use \'auto\', \'stream\' or \'load\'.')
+        if type(per_request) != int or per_request > 10000 or per_request < 1:
+            warnings.warn('Invalid entry. The per_request parameter is between 1 and 10000. Value will be set to 10000',
                           UserWarning)
             per_request = 10000
 
         check_table(self.table)
-        if type(data) != pd.DataFrame:
-            if type(data[0]) == dict:
-                df = pd.DataFrame(data)
-            elif type(data[0]) == list:
-                columns = data[0]
-                values = data[1:]
-                df = pd.DataFrame(columns=columns, data=values)
-            else:
-                raise TypeError(
-                    'Data is not specified in the correct format. It needs to be either:\n\n'
-                    ' - a pandas DataFrame\n'
-                    ' - a list containing dictionaries with the same keys in each dictionary\n'
-                    ' - a list containing lists where the first list represents the headers and the following contain '
-                    'the data '
-                )
-        else:
-            df = data
+        df = _to_dataframe(data)
+        fields = {field.name: field for field in self.client.get_table(self.table).schema}
+
+        if mode == 'load' or (mode == 'auto' and len(df) >= LOAD_THRESHOLD):
+            file_format = _file_format(file_format)
+            self._wait(self._submit_load(_prepare(df, fields, file_format), self.table, file_format, max_bytes))
+            return []
+        return self._stream(_prepare(df, fields, 'json'), per_request, workers)
+
+    def _stream(self, df: pd.DataFrame, per_request: int, workers: int) -> List[dict]:
+        # Only a few requests per worker are turned into dictionaries ahead of the threads sending them.
+        inserted = 0
+        failed = []
+        executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        futures = set()
+
+        def collect(done):
+            nonlocal inserted
+            for future in done:
+                rows, errors = future.result()
+                inserted += rows
+                failed.extend(errors)
+
+        try:
+            for rows, row_ids in _requests(df, per_request):
+                futures.add(executor.submit(self._insert, rows, row_ids))
+                if len(futures) >= workers * 2:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    collect(done)
+            collect(wait(futures)[0])
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        print(f"{inserted} rows added to table {self.table_name}")
+        if failed:
+            print(f"Error: {failed[:10]}")
+            warnings.warn(f'{len(failed)} rows could not be inserted into {self.table_name}. They are returned by '
+                          f'insert_rows().', UserWarning)
+        return failed
+
+    def _insert(self, rows: List[dict], row_ids: List[str]):
+        # Returns the amount of inserted rows and the rows which were rejected for good.
+        inserted = 0
+        failed = []
+        for attempt in range(RETRIES + 1):
+            try:
+                errors = self.client.insert_rows_json(self.table, rows, row_ids=row_ids)
+            except (ServerError, TooManyRequests, ConnectionError, requests.exceptions.ConnectionError) as err:
+                if attempt == RETRIES:
+                    return inserted, _failed_rows(rows, err)
+                _backoff(attempt)
+                continue
+            except Exception as err:
+                # Only the rows of this request fail, the other requests are still sent.
+                return inserted, _failed_rows(rows, err)
+
+            inserted += len(rows) - len(errors)
+            retry = []
+            for error in errors:
+                if attempt < RETRIES and all(err.get('reason') in RETRY_REASONS for err in error['errors']):
+                    retry.append(error['index'])
+                else:
+                    failed.append({'row': rows[error['index']], 'errors': error['errors']})
+            if not retry:
+                break
+            rows = [rows[i] for i in retry]
+            row_ids = [row_ids[i] for i in retry]
+            _backoff(attempt)
+        return inserted, failed
+
+    def upsert(self, data: Union[list, pd.DataFrame], keys: List[str] = None, overwrite_partitions: bool = False,
+               file_format: str = None, max_bytes: int = 256 * 1024 ** 2):
+        '''
+        Write rows to the table so that writing the same rows again gives the same table, e.g. when a date range is
+        reloaded. The rows are sent with load jobs, so they do not end up in the streaming buffer, which blocks
+        DELETE, UPDATE and MERGE statements for a while.
+
+        With keys, the rows are loaded into a temporary staging table and merged into the table with one MERGE
+        statement: rows that match a row of the table on all keys replace it, the other rows are added. When the
+        table is partitioned and its partition column is in the data, only the partitions between the first and last
+        date of the data are scanned.
+
+        With overwrite_partitions=True, every partition of a time-partitioned table that the data has rows for is
+        replaced by those rows, which only costs the load jobs.
+
+        :param data: pandas DataFrame, list of dictionaries with the same keys, or list of lists where the first list
+            holds the headers. The columns must exist in the table.
+        :param keys: [optional] Columns which identify a row. Required unless overwrite_partitions=True.
+        :param overwrite_partitions: [optional] Replace whole partitions instead of merging on keys. Default: False.
+        :param file_format: [optional] 'parquet' or 'json', see insert_rows().
+        :param max_bytes: [optional] Approximate size of the rows in memory per load job, see insert_rows().
+
+        >> bq.upsert(df, keys=['date', 'device_category'])
+        >> bq.upsert(df, overwrite_partitions=True)
+        '''
+        check_table(self.table)
+        if not keys and not overwrite_partitions:
+            raise ValueError('Pass the keys that identify a row, or overwrite_partitions=True for a time-partitioned '
+                             'table.')
+        df = _to_dataframe(data)
+        if df.empty:
+            return
+        table = self.client.get_table(self.table)
+        fields = {field.name: field for field in table.schema}
+        missing = [column for column in list(df.columns) + list(keys or []) if column not in fields]
+        if missing:
+            raise ValueError(f'Columns {", ".join(map(str, missing))} are not in table {self.table_name}.')
+        file_format = _file_format(file_format)
+        df = _prepare(df, fields, file_format)
+        schema = [fields[column] for column in df.columns]
+
+        if overwrite_partitions:
+            jobs = []
+            for decorator, partition in _partitions(df, table).items():
+                jobs += self._submit_load(partition, f'{self.table}${decorator}', file_format, max_bytes,
+                                          truncate=True, schema=schema)
+            self._wait(jobs)
+            return
+
+        self._merge_staged(df, schema, file_format, max_bytes, lambda staging: _merge_query(
+            self.table, staging, list(df.columns), keys, _partition_filter(df, table, fields)))
+        print(f'{len(df)} rows merged into table {self.table_name}')
 
-        to_write = df.to_dict('records')
-        for x in range(0, math.ceil(len(to_write) / per_request)):
-            if x == math.ceil(len(to_write) / per_request) - 1:
-                insert = to_write[0 + (x * per_request):]
+    def _merge_staged(self, df: pd.DataFrame, schema: list, file_format: str, max_bytes: int,
+                      query: Callable[[str], str]):
+        # Loads the rows into a temporary staging table and runs the MERGE statement query(staging) on the table.
+        staging = f'{self.table}_staging_{uuid.uuid4().hex[:12]}'
+        try:
+            self._wait(self._submit_load(df, staging, file_format, max_bytes, truncate=True, schema=schema))
+            self.client.query(query(staging)).result()
+        finally:
+            self.client.delete_table(staging, not_found_ok=True)
+
+    def _submit_load(self, df: pd.DataFrame, destination: str, file_format: str, max_bytes: int,
+                     truncate: bool = False, schema: list = None) -> list:
+        # The frame is written to an in-memory file per chunk of about max_bytes. Every file is uploaded before the
+        # next one is written, the jobs themselves run in BigQuery at the same time. When the destination is
+        # truncated, the other chunks are only appended after the first job has finished.
+        file_format = _file_format(file_format)
+        if df.empty:
+            return []
+
+        row_bytes = df.memory_usage(index=False, deep=True).sum() / len(df)
+        rows_per_job = max(1, int(max_bytes // max(row_bytes, 1)))
+
+        jobs = []
+        for start in range(0, len(df), rows_per_job):
+            job_config = bigquery.LoadJobConfig(source_format=LOAD_FORMATS[file_format])
+            if truncate and start == 0:
+                job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
             else:
-                insert = to_write[0 + (x * per_request): per_request + (x * per_request)]
+                job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+            if schema:
+                job_config.schema = schema
+            elif file_format == 'json':
+                job_config.autodetect = True
 
-            errors = self.client.insert_rows_json(self.table, insert)
-            if not errors:
-                print(f"{len(insert)} rows added to table {self.table_name}")
+            chunk = df.iloc[start:start + rows_per_job]
+            buffer = io.BytesIO()
+            if file_format == 'parquet':
+                chunk.to_parquet(buffer, index=False)
             else:
-                print(f"Error: {errors}")
+                chunk.to_json(buffer, orient='records', lines=True, date_format='iso')
+            buffer.seek(0)
+            job = self.client.load_table_from_file(buffer, destination, job_config=job_config)
+            if truncate and start == 0 and len(df) > rows_per_job:
+                job.result()
+            jobs.append((len(chunk), job))
+        return jobs
 
-    def read_table(self, columns: Union[list, str] = None, condition=None, return_format='df'):
+    def _wait(self, jobs: list):
+        for rows, job in jobs:
+            job.result()
+            print(f'{rows} rows loaded into table {job.destination.table_id}')
+
+    def watermark(self, column: str):
+        '''
+        Return the latest date in a date column of the table, or None when the table does not exist or is empty.
+        The column may be a DATE, DATETIME or TIMESTAMP column, or a STRING column with YYYYMMDD or YYYY-MM-DD dates.
+        '''
+        check_table(self.table)
+        try:
+            fields = {field.name: field for field in self.client.get_table(self.table).schema}
+            if column not in fields:
+                raise ValueError(f'Column {column} is not in table {self.table_name}.')
+            df = self.read_table(f'MAX({_date_sql(f"`{column}`", fields[column].field_type.upper())}) AS watermark')
+        except NotFound:
+            return None
+        if df.empty or pd.isna(df['watermark'][0]):
+            return None
+        return pd.Timestamp(df['watermark'][0])
+
+    def replace_from(self, column: str, start: str, results: List[pd.DataFrame]):
+        '''
+        Delete the rows from the given date onwards and add the new results in their place. The results need the
+        column names of the table. They are loaded into a staging table first, and one MERGE statement then deletes
+        the old rows and inserts the new ones, so a failed load or statement leaves the table as it was. Rows which
+        were streamed into the table less than about 30 minutes ago cannot be deleted yet.
+
+        In a STRING date column, dates are compared whether they are YYYYMMDD, like ga:date in older tables, or
+        YYYY-MM-DD. The new dates are written in the format of the existing rows.
+        '''
+        check_table(self.table)
+        results = [result for result in results if not result.empty]
+        try:
+            fields = {field.name: field for field in self.client.get_table(self.table).schema}
+        except NotFound:
+            if results:
+                raise
+            return
+        df = pd.concat(results) if results else pd.DataFrame(columns=[column])
+        missing = [col for col in list(df.columns) + [column] if col not in fields]
+        if missing:
+            raise ValueError(f'Columns {", ".join(map(str, missing))} are not in table {self.table_name}. '
+                             f'Query.refresh() names the columns like Query.to_sqlite(), e.g. Device_Category for '
+                             f'ga:deviceCategory.')
+        field_type = fields[column].field_type.upper()
+        if df.empty:
+            self.delete_rows(f"{_date_sql(f'`{column}`', field_type)} >= DATE '{start}'")
+            return
+
+        if field_type == 'STRING':
+            df[column] = _to_datetime(df[column], utc=False).dt.strftime(self._date_format(fields[column]))
+        file_format = _file_format(None)
+        df = _prepare(df, fields, file_format)
+        self._merge_staged(df, [fields[col] for col in df.columns], file_format, 256 * 1024 ** 2,
+                           lambda staging: _replace_query(self.table, staging, list(df.columns),
+                                                          _date_sql(f'T.`{column}`', field_type), start))
+        print(f'{len(df)} rows replaced in table {self.table_name}')
+
+    def _date_format(self, field) -> str:
+        # The format of the dates in a STRING column, from its first rows. Listing rows is free, unlike a query.
+        for row in self.client.list_rows(self.table, selected_fields=[field], max_results=100):
+            if row[field.name]:
+                return '%Y%m%d' if len(row[field.name]) == 8 else '%Y-%m-%d'
+        return '%Y-%m-%d'
+
+    def read_table(self, columns: Union[list, str] = None, condition=None, return_format='df',
+                   chunksize: int = None) -> Union[pd.DataFrame, list, Iterator]:
+        '''
+        Read the table, or some of its columns and rows. When pyarrow is installed the rows are downloaded as Arrow
+        record batches, through the BigQuery Storage Read API when google-cloud-bigquery-storage is installed as
+        well, and converted column by column instead of row by row.
+
+        :param columns: [optional] Column name, list of column names or any SELECT expression. Default: all columns.
+        :param condition: [optional] WHERE clause without the WHERE keyword.
+        :param return_format: [optional] 'df' for a pandas DataFrame (default), 'dict' for a list of dictionaries
+            and 'list' for a list of lists without the headers.
+        :param chunksize: [optional] Return an iterator which yields the rows in parts of chunksize rows, in the
+            given return_format, instead of reading the whole table into memory.
+
+        >> for df in bq.read_table(chunksize=1000000):
+        >>     print(len(df))
+        '''
+        if return_format not in ('df', 'dict', 'list'):
+            warnings.warn(
+                f"Format {return_format} is not valid. There will be data returned in the form of a pd.DataFrame.\n"
+                f"The valid formats are:\n\n"
+                f"'df' - Returns pandas DataFrame (default).\n"
+                f"'dict' - Returns list of dictionaries.\n"
+                f"'list' - Returns list of lists containing the rows. Headers will be lost."
+            )
+            return_format = 'df'
         check_table(self.table)
         if columns:
             if type(columns) == list:
@@ -121,27 +458,246 @@ class BigQuery:
 
         query_job = self.client.query(query)
 
-        result = query_job.result()
+        result = query_job.result(page_size=chunksize)
+        if chunksize:
+            return (_convert(part, return_format) for part in self._iter_parts(result, chunksize))
+        if pyarrow is None:
+            return _convert(_rows(result), return_format)
+        return _convert(result.to_arrow(bqstorage_client=self._storage_client(), create_bqstorage_client=False),
+                        return_format)
+
+    def _iter_parts(self, result, chunksize: int):
+        # Yields Arrow tables, or lists of rows without pyarrow, of chunksize rows.
+        if pyarrow is None:
+            rows = []
+            for page in result.pages:
+                rows.extend(_rows(page))
+                while len(rows) >= chunksize:
+                    yield rows[:chunksize]
+                    rows = rows[chunksize:]
+            if rows:
+                yield rows
+            return
 
-        result_rows = []
-        for row in result:
-            row_values = dict(zip(list(row.keys()), list(row.values())))
-            result_rows.append(row_values)
+        batches = []
+        size = 0
+        for batch in result.to_arrow_iterable(bqstorage_client=self._storage_client()):
+            batches.append(batch)
+            size += batch.num_rows
+            while size >= chunksize:
+                table = pyarrow.Table.from_batches(batches)
+                yield table.slice(0, chunksize)
+                rest = table.slice(chunksize)
+                batches, size = rest.to_batches(), rest.num_rows
+        if size:
+            yield pyarrow.Table.from_batches(batches)
 
+    def _storage_client(self):
+        # The Storage Read API client is optional, without it the rows are downloaded page by page over REST.
+        if bigquery_storage is None or pyarrow is None:
+            return None
+        credentials = get_credentials(self.keyfile, SCOPES)
+        return get_client('bigquery_storage', self.keyfile,
+                          lambda: bigquery_storage.BigQueryReadClient(credentials=credentials))
+
+
+def _to_dataframe(data: Union[list, pd.DataFrame]) -> pd.DataFrame:
+    if type(data) == pd.DataFrame:
+        return data
+    if type(data[0]) == dict:
+        return pd.DataFrame(data)
+    elif type(data[0]) == list:
+        columns = data[0]
+        values = data[1:]
+        return pd.DataFrame(columns=columns, data=values)
+    raise TypeError(
+        'Data is not specified in the correct format. It needs to be either:\n\n'
+        ' - a pandas DataFrame\n'
+        ' - a list containing dictionaries with the same keys in each dictionary\n'
+        ' - a list containing lists where the first list represents the headers and the following contain '
+        'the data '
+    )
+
+
+def _file_format(file_format: str = None) -> str:
+    if file_format is None:
+        file_format = 'parquet' if pyarrow is not None else 'json'
+    if file_format not in LOAD_FORMATS:
+        raise ValueError(f'{file_format} is not a valid file format. Use \'parquet\' or \'json\'.')
+    if file_format == 'parquet' and pyarrow is None:
+        raise ImportError('Loading Parquet requires pyarrow. Install it with "pip install pyarrow", or use '
+                          'file_format=\'json\'.')
+    return file_format
+
+
+def _prepare(df: pd.DataFrame, fields: dict, file_format: str) -> pd.DataFrame:
+    # Values are converted to the type of their column, so text like '1', 'true' or '2021-01-01 10:00:00', for which
+    # schema() infers INT64, BOOL or TIMESTAMP, can be written to those columns. The json format is used for
+    # streaming inserts as well.
+    df = df.copy(deep=False)
+    for column in df.columns:
+        field = fields.get(column)
+        if field is None or field.mode == 'REPEATED':
+            continue
+        field_type = field.field_type.upper()
+        try:
+            df[column] = _cast(df[column], field_type, file_format)
+        except (ValueError, TypeError) as err:
+            raise ValueError(f'Column {column} cannot be converted to {field_type}, its type in the table: {err}') \
+                from err
+    return df
+
+
+def _cast(series: pd.Series, field_type: str, file_format: str) -> pd.Series:
+    # Dates, like the ga:date results, are datetime64 columns in pandas. BigQuery only accepts them in a DATE column
+    # as dates, and in a STRING column as text.
+    if field_type in ('INT64', 'INTEGER') and not pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series).astype('Int64')
+    if field_type in ('FLOAT64', 'FLOAT') and not pd.api.types.is_float_dtype(series):
+        return pd.to_numeric(series).astype('float64')
+    if field_type in ('BOOL', 'BOOLEAN') and not pd.api.types.is_bool_dtype(series):
+        return series.map(_bool_value).astype('boolean')
+    if field_type == 'DATE':
+        dates = _to_datetime(series, utc=False)
+        return dates.dt.date if file_format == 'parquet' else dates.dt.strftime('%Y-%m-%d')
+    if field_type == 'TIMESTAMP' and not isinstance(series.dtype, pd.DatetimeTZDtype):
+        return _to_datetime(series, utc=True)
+    if field_type == 'DATETIME' and not pd.api.types.is_datetime64_dtype(series):
+        return _to_datetime(series, utc=False)
+    if field_type == 'STRING' and pd.api.types.is_datetime64_any_dtype(series):
+        return series.astype(str)
+    return series
+
+
+def _bool_value(value):
+    if isinstance(value, str):
+        return {'true': True, 'false': False}.get(value.strip().lower(), value)
+    return value
+
+
+def _to_datetime(series: pd.Series, utc: bool) -> pd.Series:
+    try:
+        return pd.to_datetime(series, utc=utc)
+    except (ValueError, TypeError):
+        # Text in several formats, e.g. with and without seconds, is not parsed at once by pandas.
+        return pd.to_datetime(series.map(lambda value: pd.to_datetime(value, utc=utc)), utc=utc)
+
+
+def _partitions(df: pd.DataFrame, table) -> dict:
+    # Groups the rows per partition decorator of the table, e.g. 20210131 for daily partitions.
+    partitioning = table.time_partitioning
+    if partitioning is None or not partitioning.field:
+        raise ValueError(f'{table.table_id} is not partitioned on a column, so its partitions cannot be '
+                         f'overwritten. Create the table with partition_by, or upsert with keys.')
+    if partitioning.field not in df.columns:
+        raise ValueError(f'The data has no {partitioning.field} column, which the table is partitioned on.')
+    values = pd.to_datetime(df[partitioning.field], utc=True)
+    if values.isna().any():
+        raise ValueError(f'Rows without a value for {partitioning.field} cannot be written to a partition.')
+    decorators = values.dt.strftime(PARTITION_DECORATORS[partitioning.type_])
+    return {decorator: partition for decorator, partition in df.groupby(decorators.values)}
+
+
+def _partition_filter(df: pd.DataFrame, table, fields: dict) -> str:
+    # Limits the MERGE to the partitions the data falls in, so the rest of the table is not scanned.
+    partitioning = table.time_partitioning
+    if partitioning is None or partitioning.field not in df.columns:
+        return ''
+    values = pd.to_datetime(df[partitioning.field], utc=True)
+    if values.isna().any():
+        return ''
+    field_type = fields[partitioning.field].field_type.upper()
+    formats = {'DATE': "DATE '%Y-%m-%d'", 'DATETIME': "DATETIME '%Y-%m-%d %H:%M:%S.%f'",
+               'TIMESTAMP': "TIMESTAMP '%Y-%m-%d %H:%M:%S.%f UTC'"}
+    return (f' AND T.`{partitioning.field}` BETWEEN {values.min().strftime(formats[field_type])} AND '
+            f'{values.max().strftime(formats[field_type])}')
+
+
+def _merge_query(table: str, staging: str, columns: List[str], keys: List[str], partition_filter: str = '') -> str:
+    query = f'MERGE `{table}` T USING `{staging}` S ON '
+    query += ' AND '.join(f'T.`{key}` = S.`{key}`' for key in keys) + partition_filter
+    update = [column for column in columns if column not in keys]
+    if update:
+        query += ' WHEN MATCHED THEN UPDATE SET ' + ', '.join(f'`{column}` = S.`{column}`' for column in update)
+    query += (f' WHEN NOT MATCHED THEN INSERT ({", ".join(f"`{column}`" for column in columns)}) '
+              f'VALUES ({", ".join(f"S.`{column}`" for column in columns)})')
+    return query
+
+
+def _replace_query(table: str, staging: str, columns: List[str], date: str, start: str) -> str:
+    # No row matches, so every table row from start onwards is deleted and every staging row is inserted. date is
+    # the date of a table row, see _date_sql.
+    return (f'MERGE `{table}` T USING `{staging}` S ON FALSE '
+            f'WHEN NOT MATCHED BY SOURCE AND {date} >= DATE \'{start}\' THEN DELETE '
+            f'WHEN NOT MATCHED THEN INSERT ({", ".join(f"`{col}`" for col in columns)}) '
+            f'VALUES ({", ".join(f"S.`{col}`" for col in columns)})')
+
+
+def _date_sql(column: str, field_type: str) -> str:
+    # The date of a column as a DATE. STRING columns may hold YYYYMMDD, like ga:date in older tables, YYYY-MM-DD or
+    # YYYY-MM-DD HH:MM:SS.
+    if field_type == 'STRING':
+        return f"COALESCE(SAFE.PARSE_DATE('%Y%m%d', {column}), SAFE_CAST(SUBSTR({column}, 1, 10) AS DATE))"
+    if field_type == 'DATE':
+        return column
+    return f'DATE({column})'
+
+
+def _rows(rows) -> List[dict]:
+    return [dict(row.items()) for row in rows]
+
+
+def _convert(data, return_format: str) -> Union[pd.DataFrame, list]:
+    # data is an Arrow table, or a list of dictionaries when pyarrow is not installed.
+    if pyarrow is None or not isinstance(data, pyarrow.Table):
         if return_format == 'list':
-            return [f.values() for f in result_rows]
+            return [list(row.values()) for row in data]
         elif return_format == 'dict':
-            return result_rows
-        elif return_format == 'df':
-            return pd.DataFrame(result_rows)
-        else:
-            warnings.warn(
-                f"Format {return_format} is not valid. There will be data returned in the form of a pd.DataFrame.\n"
-                f"The valid formats are:\n\n"
-                f"'df' - Returns pandas DataFrame (default).\n"
-                f"'dict' - Returns list of dictionaries.\n"
-                f"'list' - Returns list of lists containing the rows. Headers will be lost."
-            )
+            return data
+        return pd.DataFrame(data)
+
+    if return_format == 'list':
+        return [list(row) for row in zip(*data.to_pydict().values())]
+    elif return_format == 'dict':
+        return data.to_pylist()
+    return data.to_pandas()
+
+
+def _requests(df: pd.DataFrame, per_request: int):
+    # Splits the frame into requests of at most per_request rows and MAX_REQUEST_BYTES, with an insert ID per row.
+    for start in range(0, len(df), per_request):
+        rows, row_ids, size = [], [], 0
+        for row in df.iloc[start:start + per_request].to_dict('records'):
+            row = {column: _json_value(value) for column, value in row.items()}
+            row_size = len(json.dumps(row)) + 50
+            if rows and size + row_size > MAX_REQUEST_BYTES:
+                yield rows, row_ids
+                rows, row_ids, size = [], [], 0
+            rows.append(row)
+            row_ids.append(str(uuid.uuid4()))
+            size += row_size
+        if rows:
+            yield rows, row_ids
+
+
+def _failed_rows(rows: List[dict], err: Exception) -> List[dict]:
+    # Rows of a request which failed as a whole, in the format of the rows BigQuery rejects.
+    return [{'row': row, 'errors': [{'reason': type(err).__name__, 'message': str(err)}]} for row in rows]
+
+
+def _json_value(value):
+    # insert_rows_json sends the rows as JSON, which has no timestamps, numpy scalars or NaN.
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or value is pd.NaT or value is pd.NA or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _backoff(attempt: int):
+    time.sleep(BACKOFF * 2 ** attempt + random.uniform(0, BACKOFF))
 
 
 def check_table_format(table):
@@ -1,6 +1,6 @@
 from typing import List
 import pandas as pd
-from datetime import datetime
+from datetime import date, datetime
 
 
 class SchemaTypes:
@@ -26,28 +26,83 @@ class SchemaTypes:
     JSON = 'JSON'
 
 
-def schema(df: pd.DataFrame) -> List[list]:
+# Patterns for text values, checked in this order. Integers with leading zeros are kept as STRING, since they are
+# usually codes.
+PATTERNS = [
+    ('INT64', r'[+-]?(0|[1-9][0-9]*)'),
+    ('FLOAT64', r'[+-]?((0|[1-9][0-9]*)(\.[0-9]*)?|\.[0-9]+)([eE][+-]?[0-9]+)?'),
+    ('DATE', r'[0-9]{4}-[0-9]{2}-[0-9]{2}'),
+    ('TIMESTAMP', r'[0-9]{4}-[0-9]{2}-[0-9]{2}[ T][0-9]{2}:[0-9]{2}(:[0-9]{2}(\.[0-9]+)?)?'
+                  r'( ?Z|[+-][0-9]{2}:?[0-9]{2})?')
+]
+
+
+def schema(df: pd.DataFrame, sample: int = 1000) -> List[list]:
     '''
-    Create a BigQuery table schema based on the data types of a pandas DataFrame.
+    Create a BigQuery table schema based on the data types of a pandas DataFrame. The type of text columns is
+    inferred from a sample of their values, so a column of numbers, dates or booleans stored as text does not
+    become a STRING column. Datetime columns with only dates, like ga:date, become DATE columns. BigQuery.insert_rows()
+    converts the values to these types.
 
     :param df: pandas DataFrame to base the schema on.
+    :param sample: [optional] Amount of values of every text column to infer its type from. Use 0 to make every
+        text column STRING. Default: 1000.
     :return: List of column names and data types.
     '''
-    columns = df.columns.to_list()
-    types = [f.name for f in list(df.dtypes.values)]
-
     return_schema = []
-    for i, _ in enumerate(types):
-        if _.replace('[ns]', '').upper() in SchemaTypes.__dict__.keys():
-            return_schema.append([columns[i], SchemaTypes.__dict__[_.replace('[ns]', '').upper()]])
+    for column, dtype in df.dtypes.items():
+        name = dtype.name.replace('[ns]', '').upper()
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            type_ = SchemaTypes.TIMESTAMP
+        elif pd.api.types.is_datetime64_dtype(dtype):
+            type_ = SchemaTypes.DATE if _is_date(df[column]) else SchemaTypes.DATETIME
+        elif pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+            type_ = _infer_type(df[column], sample) if sample else SchemaTypes.STRING
+        elif name in SchemaTypes.__dict__.keys():
+            type_ = SchemaTypes.__dict__[name]
+        elif pd.api.types.is_bool_dtype(dtype):
+            type_ = SchemaTypes.BOOL
+        elif pd.api.types.is_integer_dtype(dtype):
+            type_ = SchemaTypes.INT64
+        elif pd.api.types.is_float_dtype(dtype):
+            type_ = SchemaTypes.FLOAT64
         else:
-            return_schema.append([columns[i], SchemaTypes.STRING])
+            type_ = SchemaTypes.STRING
+        return_schema.append([column, type_])
 
     return return_schema
 
 
+def _is_date(series: pd.Series) -> bool:
+    # Dates, like the ga:date results, are datetime64 columns in pandas with every value at midnight.
+    values = series.dropna()
+    return not values.empty and (values == values.dt.normalize()).all()
 
 
+def _infer_type(series: pd.Series, sample: int) -> str:
+    values = series.dropna()
+    if len(values) > sample:
+        values = values.sample(sample, random_state=0)
+    if values.empty:
+        return SchemaTypes.STRING
 
+    if all(isinstance(value, bool) for value in values):
+        return SchemaTypes.BOOL
+    if all(isinstance(value, datetime) for value in values):
+        return SchemaTypes.TIMESTAMP if all(value.tzinfo for value in values) else SchemaTypes.DATETIME
+    if all(isinstance(value, date) for value in values):
+        return SchemaTypes.DATE
+    if not all(isinstance(value, str) for value in values):
+        return SchemaTypes.STRING
 
-
+    text = values.astype(str).str.strip()
+    if text.str.lower().isin(['true', 'false']).all():
+        return SchemaTypes.BOOL
+    for type_, pattern in PATTERNS:
+        if text.str.fullmatch(pattern).all():
+            # The patterns also match impossible dates like 2021-13-01.
+            if type_ in (SchemaTypes.DATE, SchemaTypes.TIMESTAMP) and \
+                    text.apply(lambda value: pd.to_datetime(value, errors='coerce', utc=True)).isna().any():
+                return SchemaTypes.STRING
+            return type_
+    return SchemaTypes.STRING
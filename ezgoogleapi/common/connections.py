@@ -0,0 +1,154 @@
+import json
+import os
+import socket
+import threading
+from typing import Any, Callable, List, Optional
+
+from google.auth.transport.requests import Request
+from google.oauth2.service_account import Credentials
+
+_lock = threading.RLock()
+_refresh_lock = threading.Lock()
+_credentials = {}
+_documents = {}
+_clients = {}
+_local = threading.local()
+_transport = {'transport': 'thread', 'pool_size': 10, 'timeout': 120}
+
+
+def configure_transport(transport: str = 'thread', pool_size: int = 10, timeout: float = 120):
+    '''
+    Choose how the googleapiclient based services (Analytics, Sheets and Drive) send their requests. Applies to
+    services requested after the call.
+
+    :param transport: [optional] 'thread' (default) builds a service on httplib2 for every thread. 'pooled' builds
+        one service per keyfile on a requests session with a pool of keep-alive connections, which can be shared by
+        any amount of threads.
+    :param pool_size: [optional] Maximum amount of open connections per host for the 'pooled' transport.
+        Default: 10.
+    :param timeout: [optional] Socket timeout in seconds for both transports. Default: 120.
+    '''
+    if transport not in ('thread', 'pooled'):
+        raise ValueError(f'{transport} is not a valid transport. Use \'thread\' or \'pooled\'.')
+    with _lock:
+        _transport.update(transport=transport, pool_size=pool_size, timeout=timeout)
+
+
+def get_credentials(keyfile: str, scopes: List[str]) -> Credentials:
+    '''
+    Return the credentials for a keyfile and scopes, shared by the whole process. The access token is reused by
+    every service built on the credentials and only refreshed when it is about to expire.
+
+    :param keyfile: Path to the JSON keyfile.
+    :param scopes: List of OAuth scopes.
+    '''
+    key = (os.path.abspath(keyfile), tuple(sorted(scopes)))
+    with _lock:
+        if key not in _credentials:
+            _credentials[key] = Credentials.from_service_account_file(keyfile, scopes=scopes)
+        return _credentials[key]
+
+
+def refresh(credentials: Credentials) -> Credentials:
+    '''
+    Fetch an access token when the credentials have none, or when it is about to expire.
+    '''
+    with _refresh_lock:
+        if not credentials.valid:
+            credentials.refresh(Request())
+    return credentials
+
+
+def get_service(api: str, version: str, keyfile: str, scopes: List[str]) -> Any:
+    '''
+    Return a service for a Google API. The discovery document is read from the documents shipped with
+    google-api-python-client once per process. With the 'thread' transport the service is built once per thread,
+    since httplib2 is not thread-safe. With the 'pooled' transport one service is shared by all threads.
+
+    :param api: Name of the API, e.g. 'analyticsreporting'.
+    :param version: Version of the API, e.g. 'v4'.
+    :param keyfile: Path to the JSON keyfile.
+    :param scopes: List of OAuth scopes.
+    '''
+    credentials = get_credentials(keyfile, scopes)
+    transport = dict(_transport)
+    key = (api, version, id(credentials), tuple(transport.items()))
+    if transport['transport'] == 'pooled':
+        return get_client(key, keyfile, lambda: _build(api, version, _SessionHttp(credentials, transport['pool_size'],
+                                                                                  transport['timeout'])))
+
+    if not hasattr(_local, 'services'):
+        _local.services = {}
+    if key not in _local.services:
+        import google_auth_httplib2
+        import httplib2
+        http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=transport['timeout']))
+        _local.services[key] = _build(api, version, http)
+    return _local.services[key]
+
+
+def get_client(name: Any, keyfile: str, factory: Callable[[], Any]) -> Any:
+    '''
+    Return a thread-safe client, such as a bigquery.Client, shared by the whole process. The client is created with
+    factory the first time it is requested for a keyfile.
+    '''
+    key = (name, os.path.abspath(keyfile))
+    with _lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def _build(api: str, version: str, http: Any) -> Any:
+    from googleapiclient.discovery import build, build_from_document
+
+    document = _discovery_document(api, version)
+    if document is None:
+        return build(api, version, http=http)
+    return build_from_document(document, http=http)
+
+
+def _discovery_document(api: str, version: str) -> Optional[dict]:
+    # None when google-api-python-client does not ship the document, then build() fetches it.
+    from googleapiclient import discovery_cache
+
+    key = (api, version)
+    with _lock:
+        if key not in _documents:
+            document = discovery_cache.get_static_doc(api, version)
+            _documents[key] = json.loads(document) if document is not None else None
+        return _documents[key]
+
+
+class _SessionHttp:
+    def __init__(self, credentials: Credentials, pool_size: int, timeout: float):
+        '''
+        Thread-safe stand-in for httplib2.Http, which sends the requests of googleapiclient over an AuthorizedSession
+        with a pool of keep-alive connections.
+        '''
+        import requests
+        from google.auth.transport.requests import AuthorizedSession
+
+        self.session = AuthorizedSession(credentials)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.timeout = timeout
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        import httplib2
+        import requests
+
+        try:
+            response = self.session.request(method, uri, data=body, headers=headers, timeout=self.timeout)
+        except requests.exceptions.Timeout as err:
+            # googleapiclient retries these when execute() is called with num_retries.
+            raise socket.timeout(str(err)) from err
+        except requests.exceptions.ConnectionError as err:
+            raise ConnectionError(str(err)) from err
+        info = dict(response.headers)
+        info['status'] = str(response.status_code)
+        info['reason'] = response.reason
+        return httplib2.Response(info), response.content
+
+    def close(self):
+        self.session.close()
@@ -4,13 +4,15 @@ BASE_DIR = os.getcwd()
 
 
 class SamplingError(Exception):
-    def __init__(self, percentage, csv):
+    def __init__(self, percentage, journal=None):
+        self.sample_size = percentage
         self.percentage = round(percentage * 100, 1)
-        csv_string = ''
-        if csv:
-            csv_string = f' and results untill now have been saved to {BASE_DIR + "/partial_results.csv"}'
+        journal_string = ''
+        if journal:
+            journal_string = f' and the days completed untill now have been saved to {journal}. Use ' \
+                             f'Query.run(resume=True) to continue from there'
         self.message = f'Sampling detected in results ({self.percentage}%) and sampling is set to \'fail\'\n. ' \
-                       f'Execution of queries is stopped{csv_string}. If you want to continue when sampling is ' \
+                       f'Execution of queries is stopped{journal_string}. If you want to continue when sampling is ' \
                        f'encountered, then use the option sampling=\'skip\' to only save results without sampling or ' \
                        f'sampling=\'save\' to keep all the results.'
         super().__init__(self.message)
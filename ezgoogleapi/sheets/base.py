@@ -1,9 +1,7 @@
 from typing import Union
 import numpy as np
-from google.oauth2 import service_account
 import pandas as pd
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
+from ezgoogleapi.common.connections import get_credentials, get_service, refresh
 from ezgoogleapi.common.validation import check_keyfile, check_range, request_wrapper, validate_email, \
     check_data_to_write
 import math
@@ -11,21 +9,15 @@ from ezgoogleapi.sheets.ranges import _get_ranges, _get_columns
 
 
 def create_conn_sheets(keyfile):
-    creds = service_account.Credentials.from_service_account_file(
-        keyfile, scopes=['https://www.googleapis.com/auth/spreadsheets'])
-    creds.refresh(Request())
-
-    service = build('sheets', 'v4', credentials=creds)
-    return service.spreadsheets()
+    scopes = ['https://www.googleapis.com/auth/spreadsheets']
+    refresh(get_credentials(keyfile, scopes))
+    return get_service('sheets', 'v4', keyfile, scopes).spreadsheets()
 
 
 def create_conn_drive(keyfile):
-    creds = service_account.Credentials.from_service_account_file(
-        keyfile, scopes=['https://www.googleapis.com/auth/drive'])
-    creds.refresh(Request())
-
-    service = build('drive', 'v3', credentials=creds)
-    return service
+    scopes = ['https://www.googleapis.com/auth/drive']
+    refresh(get_credentials(keyfile, scopes))
+    return get_service('drive', 'v3', keyfile, scopes)
 
 
 class Permission:
@@ -15,8 +15,17 @@ setup(
         'google>=3.0.0',
         'google-api-python-client>=2.14.1',
         'pandas>=1.3.1',
-        'google-cloud-bigquery>=2.23.1',
-        'validators'
+        'google-cloud-bigquery>=3.0.0',
+        'validators',
+        'tzdata; platform_system == "Windows"'
     ],
-    packages=find_packages()
+    extras_require={
+        'async': ['aiohttp>=3.8'],
+        'parquet': ['pyarrow>=3.0.0'],
+        'storage': ['pyarrow>=3.0.0', 'google-cloud-bigquery-storage>=2.0.0']
+    },
+    packages=find_packages(),
+    package_data={
+        'ezgoogleapi.analytics': ['data/*.json.gz']
+    }
 )
\ No newline at end of file
@@ -0,0 +1,122 @@
+'''
+AsyncQuery against a local Reporting API stub server.
+
+>> python -m pytest tests
+'''
+import asyncio
+import json
+
+import pandas as pd
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+from google.auth.credentials import AnonymousCredentials
+
+from ezgoogleapi.analytics import async_query, variable_names
+from ezgoogleapi.analytics.async_query import AsyncQuery
+from ezgoogleapi.analytics.body import compile_template
+from ezgoogleapi.analytics.cache import ReportCache
+
+
+class StubBody:
+    '''
+    Body with one dimension and one metric, which does not need the variable name catalog.
+    '''
+    def __init__(self, start: str, end: str):
+        self.body = {'reportRequests': [{'viewId': '1', 'metrics': [{'expression': 'ga:sessions'}],
+                                         'dimensions': [{'name': 'ga:date'}], 'samplingLevel': 'LARGE'}]}
+        self.date_range = [start, end]
+        self.resource_quota = False
+        self.name = 'stub'
+        compile_template(self)
+
+    def request(self, date_ranges: list) -> dict:
+        return json.loads(json.dumps(date_ranges).join(self.template))
+
+
+def report(body: dict) -> dict:
+    date = body['reportRequests'][0]['dateRanges'][0]['startDate']
+    return {'reports': [{
+        'columnHeader': {'dimensions': ['ga:date'],
+                         'metricHeader': {'metricHeaderEntries': [{'name': 'ga:sessions', 'type': 'INTEGER'}]}},
+        'data': {'rows': [{'dimensions': [date.replace('-', '')], 'metrics': [{'values': ['5']}]}], 'rowCount': 1}
+    }]}
+
+
+def run_against(statuses: list, start: str = '2021-01-01', end: str = '2021-01-01'):
+    '''
+    Run an AsyncQuery against a stub server which answers with the given statuses before it returns the report.
+    '''
+    calls = []
+
+    async def batch_get(request):
+        body = await request.json()
+        calls.append(body)
+        if len(calls) <= len(statuses):
+            return web.json_response({'error': {'code': statuses[len(calls) - 1]}}, status=statuses[len(calls) - 1])
+        return web.json_response(report(body))
+
+    async def main():
+        app = web.Application()
+        app.router.add_post('/v4/reports:batchGet', batch_get)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        try:
+            async with AsyncQuery(StubBody(start, end), credentials=AnonymousCredentials(), cache=ReportCache(0),
+                                  endpoint=f'http://{host}:{port}/v4/reports:batchGet') as query:
+                await query.run(logging=False)
+                return query.to_dataframe()
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(main()), calls
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(async_query, 'BACKOFF', 0)
+
+
+@pytest.fixture(autouse=True)
+def catalog(monkeypatch, tmp_path):
+    '''
+    Variable names of the stub report, so the tests neither download the catalog nor write its database into the
+    package.
+    '''
+    records = [{'name': 'Date', 'apicode': 'ga:date', 'type': 'Dimension'},
+               {'name': 'Sessions', 'apicode': 'ga:sessions', 'type': 'Metric'}]
+    stub = variable_names._Catalog.__new__(variable_names._Catalog)
+    stub.all_names = pd.DataFrame(records)
+    stub.by_name = {record['name'].lower(): record for record in records}
+    stub.by_apicode = {record['apicode'].lower(): record for record in records}
+    stub.cd_cm = False
+    monkeypatch.setattr(variable_names, 'DIR', str(tmp_path))
+    monkeypatch.setattr(variable_names, '_catalog', stub)
+
+
+def test_run_returns_every_day():
+    df, calls = run_against([], end='2021-01-03')
+    assert len(calls) == 3
+    assert df['Sessions'].tolist() == [5, 5, 5]
+
+
+def test_retries_rate_limits_and_server_errors():
+    df, calls = run_against([429, 503, 500])
+    assert len(calls) == 4
+    assert len(df) == 1
+
+
+def test_gives_up_after_retries():
+    with pytest.raises(aiohttp.ClientResponseError) as err:
+        run_against([503] * (async_query.RETRIES + 1))
+    assert err.value.status == 503
+
+
+def test_client_errors_are_not_retried():
+    with pytest.raises(aiohttp.ClientResponseError) as err:
+        run_against([400, 400])
+    assert err.value.status == 400